@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+"""
+Offline analysis of histories saved with sim.py --save-history.  Maps the
+files back in with History.load and prints the same summary stats as the
+end of a sim.py run, without re-running anything.
+
+Usage:  analyze.py [options] FILE [FILE ...]
+"""
+
+import sys
+from optparse import OptionParser
+
+from history import History
+from stats import Stats, stddev_str
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options] FILE [FILE ...]"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--pretty",
+                      dest="pretty", default=False, action="store_true",
+                      help="Also print each history round by round")
+
+    parser.add_option("--per-run",
+                      dest="per_run", default=False, action="store_true",
+                      help="Also print the stats for each file on its own")
+
+    (options, args) = parser.parse_args(args[1:])
+    if len(args) == 0:
+        parser.error("No history files given")
+
+    histories = [History.load(filename) for filename in args]
+    try:
+        peer_ids = histories[0].peer_ids
+        for (filename, h) in zip(args, histories):
+            if options.pretty:
+                sys.stdout.writelines(h.pretty_lines())
+            if options.per_run:
+                print("======== %s: %d rounds ========" % (filename, h.num_rounds))
+                print("Uploaded blocks:\n%s" % Stats.uploaded_blocks_str(peer_ids, h))
+                print("Completion rounds:\n%s" % Stats.completion_rounds_str(peer_ids, h))
+                print("All done round: %s" % Stats.all_done_round(peer_ids, h))
+
+        uploaded_by_id = Stats.aggregate(
+            peer_ids, [Stats.uploaded_blocks(peer_ids, h) for h in histories])
+        completion_by_id = Stats.aggregate(
+            peer_ids, [Stats.completion_rounds(peer_ids, h) for h in histories])
+
+        print("======== SUMMARY STATS (%d runs) ========" % len(histories))
+        print("Uploaded blocks: avg (stddev)")
+        for p_id in sorted(peer_ids, key=lambda id: uploaded_by_id[id][0]):
+            (m, sd, _) = uploaded_by_id[p_id]
+            print("%s: %.1f  (%.1f)" % (p_id, m, sd))
+
+        print("Completion rounds: avg (stddev)")
+        for p_id in sorted(peer_ids, key=lambda id: completion_by_id[id][0] or 0):
+            (m, sd, _) = completion_by_id[p_id]
+            print("%s: %s  (%s)" % (p_id, m, stddev_str(sd)))
+    finally:
+        for h in histories:
+            h.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+"""
+Deciding for a whole class of agents at once.
+
+A Peer subclass can define the classmethods requests_batch(batch) and
+uploads_batch(batch).  If it does, the sim calls them once per round with a
+Batch of all of that class's peers, instead of calling requests() and
+uploads() on each peer.  They return one list of Requests (or Uploads) per
+agent, in batch.agents order; each list gets validated just like the
+per-peer ones.
+
+Besides the per-agent views and histories, a Batch has the state of the
+round as arrays (built the first time they're used), so a strategy can work
+on every agent with a few whole-array ops.  These need numpy; without it
+they're None and a batch method should fall back to a per-agent loop.
+"""
+
+import random
+
+# numpy is optional, see above
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from messages import PeerView, NeighborView
+
+
+class Batch:
+    """
+    One round's input for a class's requests_batch or uploads_batch.
+
+    agents: the class's peers, in the sim's order.  Their pieces are up to
+            date (update_pieces has been called).
+    peers: for each agent, what it sees of the other peers (a PeerView)
+    histories: for each agent, its AgentHistory
+    requests: for uploads_batch, the requests made to each agent
+    round: the round number
+    piece_counts: piece_counts[i] is how many peers in the swarm have piece i.
+            Under a topology an agent only gets to see the counts over its
+            neighbors: use histories[k].piece_counts, or counts below.
+
+    Arrays (numpy, or None without it):
+    peer_ids: the swarm's peer ids; row j of have is peer_ids[j]
+    have: bool, swarm peers x pieces: which pieces each peer has
+    visible: bool, agents x swarm peers: who each agent sees
+    blocks: int, agents x pieces: blocks each agent has of each piece
+    counts: int, agents x pieces: the piece counts each agent sees
+    """
+    def __init__(self, agents, peers, histories, round, piece_counts,
+                 peer_info, num_pieces, requests=None):
+        """peer_info: the round's shared tuple of PeerInfos"""
+        self.agents = agents
+        self.peers = peers
+        self.histories = histories
+        self.requests = requests
+        self.round = round
+        self.piece_counts = piece_counts
+        self.peer_info = peer_info
+        self.num_pieces = num_pieces
+        self._cache = dict()
+
+    def _cached(self, name, make):
+        if np is None:
+            return None
+        if name not in self._cache:
+            self._cache[name] = make()
+        return self._cache[name]
+
+    @property
+    def peer_ids(self):
+        return self._cached("peer_ids", lambda: np.array(
+            [info.id for info in self.peer_info], dtype=object))
+
+    @property
+    def have(self):
+        return self._cached("have", self._make_have)
+
+    @property
+    def visible(self):
+        return self._cached("visible", self._make_visible)
+
+    @property
+    def blocks(self):
+        return self._cached("blocks", lambda: np.array(
+            [a.pieces for a in self.agents], dtype=np.int64).reshape(
+                len(self.agents), self.num_pieces))
+
+    @property
+    def counts(self):
+        return self._cached("counts", lambda: np.array(
+            [h.piece_counts for h in self.histories], dtype=np.int64).reshape(
+                len(self.agents), self.num_pieces))
+
+    def _make_have(self):
+        # Unpack each PieceSet's bits, lowest piece first
+        n = self.num_pieces
+        nbytes = (n + 7) // 8
+        packed = np.frombuffer(b"".join(
+            info.available_pieces.bits.to_bytes(nbytes, "little")
+            for info in self.peer_info), dtype=np.uint8).reshape(-1, nbytes)
+        return np.unpackbits(packed, axis=1, count=n,
+                             bitorder="little").astype(bool)
+
+    def _make_visible(self):
+        shared = self.peer_info
+        visible = np.zeros((len(self.agents), len(shared)), dtype=bool)
+        index = None
+        for (i, view) in enumerate(self.peers):
+            if isinstance(view, NeighborView) and view.own is None:
+                visible[i, list(view.indices)] = True
+            elif isinstance(view, PeerView) and view.own is None:
+                visible[i] = True
+                visible[i, view.skip] = False
+            else:
+                if index is None:
+                    index = dict((info.id, j) for j, info in enumerate(shared))
+                visible[i, [index[p.id] for p in view]] = True
+        return visible
+
+    def rng(self):
+        """A numpy Generator seeded from the random module, so batch
+        strategies are reproducible with the sim's --seed."""
+        return np.random.default_rng(random.getrandbits(64))
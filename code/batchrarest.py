@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+# Reference strategy for the batch API (see batch.py): request the rarest
+# pieces first from everyone, and split upload bandwidth evenly between a
+# few random requesters.  requests() and uploads() are the plain per-peer
+# version; requests_batch() and uploads_batch() do the same thing for every
+# BatchRarest peer at once with numpy.
+
+import random
+
+# numpy is optional: without it the batch methods just loop over the peers
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from messages import Upload, Request
+from util import even_split, rarest_first
+from peer import Peer
+from pieces import PieceSet
+
+
+class BatchRarest(Peer):
+    # most peers to upload to in a round
+    MAX_UPLOADS = 4
+    # requests() is empty when done, uploads() without requests too
+    skip_when_idle = True
+
+    def requests(self, peers, history):
+        bpp = self.conf.blocks_per_piece
+        np_set = PieceSet(i for i in range(len(self.pieces))
+                          if self.pieces[i] < bpp)
+        requests = []
+        for peer in peers:
+            isect = peer.available_pieces.intersection(np_set)
+            for piece_id in rarest_first(isect, history.piece_counts)[:self.max_requests]:
+                requests.append(Request(self.id, peer.id, piece_id,
+                                        self.pieces[piece_id]))
+        return requests
+
+    def uploads(self, requests, peers, history):
+        requester_ids = list(dict.fromkeys(r.requester_id for r in requests))
+        n = min(self.MAX_UPLOADS, len(requester_ids))
+        if n == 0:
+            return []
+        bws = even_split(self.up_bw, n)
+        return [Upload(self.id, peer_id, bw)
+                for (peer_id, bw) in zip(random.sample(requester_ids, n), bws)]
+
+    @classmethod
+    def requests_batch(cls, batch):
+        if np is None:
+            return [a.requests(peers, history) for (a, peers, history)
+                    in zip(batch.agents, batch.peers, batch.histories)]
+
+        bpp = batch.agents[0].conf.blocks_per_piece
+        blocks = batch.blocks
+        need = blocks < bpp
+        if not need.any():
+            # Everyone's done.  Don't touch the random stream: event-driven
+            # runs don't call this at all then (see Peer.skip_when_idle).
+            return [[] for a in batch.agents]
+        rng = batch.rng()
+        have = batch.have
+        visible = batch.visible
+        peer_ids = batch.peer_ids
+        counts = batch.counts
+
+        ans = []
+        for (i, a) in enumerate(batch.agents):
+            if not need[i].any():
+                ans.append([])
+                continue
+            seen = np.flatnonzero(visible[i])
+            # seen peers x pieces: pieces a could ask each of them for
+            cand = have[seen] & need[i]
+            # Rarest first, with ties broken at random: sort by the count
+            # plus a random fraction, and take the first max_requests.
+            key = np.where(cand, counts[i] + rng.random(cand.shape), np.inf)
+            order = np.argsort(key, axis=1)[:, :a.max_requests]
+            rows, cols = np.nonzero(np.take_along_axis(cand, order, axis=1))
+            pieces = order[rows, cols]
+            ans.append([Request(a.id, peer_id, piece_id, start)
+                        for (peer_id, piece_id, start) in zip(
+                            peer_ids[seen[rows]].tolist(), pieces.tolist(),
+                            blocks[i, pieces].tolist())])
+        return ans
+
+    @classmethod
+    def uploads_batch(cls, batch):
+        if np is None:
+            return [a.uploads(requests, peers, history)
+                    for (a, requests, peers, history) in zip(
+                        batch.agents, batch.requests, batch.peers,
+                        batch.histories)]
+
+        requesters = [list(dict.fromkeys(r.requester_id for r in requests))
+                      for requests in batch.requests]
+        if not any(requesters):
+            # Nobody asked for anything; as in requests_batch
+            return [[] for a in batch.agents]
+        rng = batch.rng()
+        # even_split for every agent at once: n shares of up_bw // n, the
+        # last up_bw % n of them one bigger
+        n = np.minimum(cls.MAX_UPLOADS, [len(ids) for ids in requesters])
+        up_bw = np.array([a.up_bw for a in batch.agents])
+        base = up_bw // np.maximum(n, 1)
+        extra = up_bw - base * n
+
+        ans = []
+        for (i, a) in enumerate(batch.agents):
+            k = int(n[i])
+            if k == 0:
+                ans.append([])
+                continue
+            bws = [int(base[i])] * (k - int(extra[i])) + [int(base[i]) + 1] * int(extra[i])
+            chosen = rng.choice(len(requesters[i]), k, replace=False).tolist()
+            ans.append([Upload(a.id, requesters[i][j], bw)
+                        for (j, bw) in zip(chosen, bws)])
+        return ans
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the simulator.  Runs Sim.run_sim_once over a grid of swarm sizes,
+file sizes and agent mixes, and reports for each:
+  - rounds per second
+  - seconds spent in each phase of a round (see profiling.PHASES)
+  - peak memory allocated during the run (from tracemalloc)
+
+Results are saved as JSON.  Pass an earlier results file with --baseline to
+see how the speed compares, e.g. to catch regressions between versions.
+
+Every run uses the same random seed, but some agents iterate over sets of
+peer ids, so set PYTHONHASHSEED too for runs that repeat exactly.
+
+Usage:  bench.py [options]
+"""
+
+import contextlib
+import io
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+from profiling import PHASES, PhaseClock
+from sim import Sim
+from util import Params, load_modules
+
+# mix name -> (class name, weight) for the non-seed peers
+MIXES = {
+    "std": [("MMJWStd", 1)],
+    "tyrant": [("MMJWTyrant", 1)],
+    "propshare": [("MMJWPropshare", 1)],
+    "tourney": [("MMJWTourney", 1)],
+    "mixed": [("MMJWStd", 1), ("MMJWTyrant", 1),
+              ("MMJWPropshare", 1), ("MMJWTourney", 1)],
+    "batch": [("BatchRarest", 1)],
+}
+
+
+def agent_names(mix, num_peers, seed_frac):
+    """
+    Class names for a swarm of num_peers: a seed_frac share of seeds (at
+    least one), with the rest split between the mix's classes by weight.
+    """
+    num_seeds = max(1, int(round(num_peers * seed_frac)))
+    rest = num_peers - num_seeds
+    classes = MIXES[mix]
+    total = sum(w for (_, w) in classes)
+    names = ["Seed"] * num_seeds
+    for i, (name, w) in enumerate(classes):
+        if i == len(classes) - 1:
+            n = num_peers - len(names)
+        else:
+            n = rest * w // total
+        names.extend([name] * n)
+    return names
+
+
+def make_config(names, num_pieces, blocks_per_piece, options):
+    config = Params()
+    config.add("agent_class_names", names)
+    config.add("agent_classes", load_modules(set(names)))
+    config.add("num_pieces", num_pieces)
+    config.add("blocks_per_piece", blocks_per_piece)
+    config.add("max_round", options.max_round)
+    config.add("min_up_bw", options.min_up_bw)
+    config.add("max_up_bw", options.max_up_bw)
+    config.add("iters", 1)
+    config.add("workers", 1)
+    config.add("seed", options.seed)
+    config.add("topology", "full")
+    config.add("history_window", options.history_window)
+    config.add("history_dir", None)
+    config.add("save_history", None)
+    config.add("batch", options.batch)
+    config.add("event_driven", options.event_driven)
+    config.add("driver", "serial")
+    config.add("driver_workers", 1)
+    config.add("deadline", None)
+    config.add("trusted_classes", [])
+    config.add("validate_every", 1)
+    return config
+
+
+def run_once(config, seed, trace_memory=False):
+    """
+    Run one simulation.  Returns (rounds, seconds, phase_times, peak bytes).
+    peak is None unless trace_memory is set.
+    """
+    sim = Sim(config)
+    clock = PhaseClock()
+    clock.install(sim)
+    random.seed(seed)
+    if trace_memory:
+        tracemalloc.start()
+    # The agents print a greeting when they start up
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        history = sim.run_sim_once()
+        seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    rounds = history.last_round() + 1
+    # Removes any rounds spilled to disk with --history-window
+    history.close()
+    return (rounds, seconds, clock.times, peak)
+
+
+def bench_case(case, options):
+    """Benchmark one point of the grid.  Returns a result dict."""
+    names = agent_names(case["mix"], case["peers"], options.seed_frac)
+    config = make_config(names, case["num_pieces"],
+                         case["blocks_per_piece"], options)
+
+    # Keep the fastest of the timed repeats; every repeat uses the same seed
+    # so they all simulate the same thing.
+    best = None
+    for i in range(options.repeat):
+        rounds, seconds, phases, _ = run_once(config, options.seed)
+        if best is None or seconds < best[1]:
+            best = (rounds, seconds, phases)
+    rounds, seconds, phases = best
+
+    # tracemalloc slows things down a lot, so memory gets its own run
+    peak = None
+    if options.memory:
+        peak = run_once(config, options.seed, trace_memory=True)[3]
+
+    result = dict(case)
+    result.update(rounds=rounds,
+                  seconds=seconds,
+                  rounds_per_sec=rounds / seconds if seconds > 0 else None,
+                  phases=dict((p, phases[p]) for p in PHASES),
+                  peak_bytes=peak)
+    return result
+
+
+def case_key(case):
+    return (case["mix"], case["peers"], case["num_pieces"],
+            case["blocks_per_piece"])
+
+
+def format_result(r, baseline=None):
+    s = "%-10s peers=%-5d pieces=%-5d bpp=%-3d rounds=%-5d %8.1f rounds/s" % (
+        r["mix"], r["peers"], r["num_pieces"], r["blocks_per_piece"],
+        r["rounds"], r["rounds_per_sec"] or 0)
+    total = sum(r["phases"].values()) or 1
+    s += "  [" + " ".join("%s %.0f%%" % (p, 100 * r["phases"][p] / total)
+                          for p in PHASES) + "]"
+    if r["peak_bytes"] is not None:
+        s += "  peak %.1fMB" % (r["peak_bytes"] / 1e6)
+    if baseline is not None:
+        old = baseline.get(case_key(r))
+        if old is not None and old["rounds_per_sec"] and r["rounds_per_sec"]:
+            s += "  (%.2fx baseline)" % (r["rounds_per_sec"] / old["rounds_per_sec"])
+    return s
+
+
+def int_list(s):
+    return [int(x) for x in s.split(",")]
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options]"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--peers",
+                      dest="peers", default="10,50,100",
+                      help="Comma-separated peer counts")
+
+    parser.add_option("--num-pieces",
+                      dest="num_pieces", default="16,64",
+                      help="Comma-separated numbers of pieces in the file")
+
+    parser.add_option("--blocks-per-piece",
+                      dest="blocks_per_piece", default="4",
+                      help="Comma-separated numbers of blocks per piece")
+
+    parser.add_option("--mixes",
+                      dest="mixes", default=",".join(sorted(MIXES)),
+                      help="Comma-separated agent mixes, from: %s" %
+                      ", ".join(sorted(MIXES)))
+
+    parser.add_option("--seed-frac",
+                      dest="seed_frac", default=0.1, type="float",
+                      help="Share of the peers that are seeds")
+
+    parser.add_option("--max-round",
+                      dest="max_round", default=1000, type="int",
+                      help="Limit on number of rounds")
+
+    parser.add_option("--min-bw",
+                      dest="min_up_bw", default=4, type="int",
+                      help="Min upload bandwidth")
+
+    parser.add_option("--max-bw",
+                      dest="max_up_bw", default=10, type="int",
+                      help="Max upload bandwidth")
+
+    parser.add_option("--no-batch",
+                      dest="batch", default=True, action="store_false",
+                      help="Don't use the agents' batch methods (see batch.py)")
+
+    parser.add_option("--event-driven",
+                      dest="event_driven", default=False, action="store_true",
+                      help="Run the sim in event-driven mode")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=None, type="int",
+                      help="Rounds of history to keep in memory (see sim.py)")
+
+    parser.add_option("--repeat",
+                      dest="repeat", default=1, type="int",
+                      help="Timed runs per case; the fastest is kept")
+
+    parser.add_option("--seed",
+                      dest="seed", default=0, type="int",
+                      help="Random seed used for every run")
+
+    parser.add_option("--no-memory",
+                      dest="memory", default=True, action="store_false",
+                      help="Skip the extra run that measures peak memory")
+
+    parser.add_option("--output",
+                      dest="output", default="bench.json",
+                      help="Where to save the results")
+
+    parser.add_option("--baseline",
+                      dest="baseline", default=None,
+                      help="Results file from an earlier run to compare to")
+
+    (options, args) = parser.parse_args(args[1:])
+
+    if options.history_window is not None and options.history_window < 0:
+        parser.error("--history-window can't be negative")
+
+    mixes = options.mixes.split(",")
+    for mix in mixes:
+        if mix not in MIXES:
+            parser.error("Unknown mix: %s" % mix)
+
+    # Only the benchmark's own output, not the simulator's
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    baseline = None
+    if options.baseline is not None:
+        with open(options.baseline) as f:
+            baseline = dict((case_key(r), r) for r in json.load(f)["results"])
+
+    results = []
+    for mix in mixes:
+        for peers in int_list(options.peers):
+            for num_pieces in int_list(options.num_pieces):
+                for bpp in int_list(options.blocks_per_piece):
+                    case = dict(mix=mix, peers=peers, num_pieces=num_pieces,
+                                blocks_per_piece=bpp)
+                    r = bench_case(case, options)
+                    results.append(r)
+                    print(format_result(r, baseline))
+                    sys.stdout.flush()
+
+    out = dict(python=platform.python_version(),
+               time=time.strftime("%Y-%m-%d %H:%M:%S"),
+               options=vars(options),
+               results=results)
+    with open(options.output, "w") as f:
+        json.dump(out, f, indent=1)
+    print("Saved results to %s" % options.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
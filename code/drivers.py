@@ -0,0 +1,432 @@
+#!/usr/bin/python
+
+"""
+Ways of calling the agents' requests() and uploads(), chosen with
+config.driver:
+
+  serial    one after the other, in this process (the default)
+  thread    concurrently, on a pool of config.driver_workers threads
+  process   concurrently, with every agent living in one of
+            config.driver_workers worker processes, for CPU-heavy agents
+
+All of them can give each call a deadline of config.deadline seconds: a
+call that runs over counts as returning nothing.  The serial and process
+drivers interrupt the agent with a SIGALRM timer (Unix only), so it may be
+left half way through updating its own state.  Threads can't be
+interrupted, so with the thread driver an agent that runs over keeps
+running in the background, and its calls count as returning nothing until
+it's done.
+
+Every driver times every call; see Driver.latency.
+
+The thread driver isn't reproducible with a --seed, since the agents share
+the random module and run in whatever order the OS picks.  The process
+driver is, for a given number of workers: each worker has its own random
+stream, seeded from the sim's.
+"""
+
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import random
+import signal
+import threading
+import time
+import traceback
+from array import array
+
+from history import History
+from messages import PeerView, NeighborView
+
+DRIVERS = ("serial", "thread", "process")
+
+# Default pool size for the thread driver.  The agents share the GIL, so
+# threads only help agents that wait on something; enough of them that a
+# few slow agents don't hold up the rest, but not one per peer in a big
+# swarm.
+THREAD_WORKERS = 64
+
+
+class AgentTimeout(BaseException):
+    """
+    Raised inside an agent when its time is up.  Not an Exception, like
+    KeyboardInterrupt, so an agent's "except Exception:" doesn't swallow it.
+    """
+    pass
+
+
+def _alarm(signum, frame):
+    raise AgentTimeout()
+
+
+def call_with_deadline(f, args, deadline):
+    """
+    Call f(*args), giving up after deadline seconds (None for no limit).
+    Must be called from the main thread.
+    Returns (result, seconds, overran); result is [] if it overran.
+    """
+    start = time.perf_counter()
+    if deadline is None:
+        result = f(*args)
+        return (result, time.perf_counter() - start, False)
+    signal.setitimer(signal.ITIMER_REAL, deadline)
+    try:
+        result = f(*args)
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        overran = False
+    except AgentTimeout:
+        result = []
+        overran = True
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    return (result, time.perf_counter() - start, overran)
+
+
+def install_alarm():
+    if threading.current_thread() is not threading.main_thread():
+        raise ValueError("Deadlines need the sim to run in the main thread")
+    signal.signal(signal.SIGALRM, _alarm)
+
+
+class Driver:
+    """
+    Calls agents one at a time.  Subclasses do it some other way.
+
+    latency: peer_id -> [calls, total seconds, slowest call, overruns]
+    round_overruns: calls this round that ran over (or were skipped for
+        it), and so came back empty whatever the agent would have said
+    """
+    def __init__(self, config):
+        self.deadline = config.deadline
+        self.latency = dict()
+        self.round_overruns = 0
+        if self.deadline is not None:
+            install_alarm()
+
+    def record(self, peer_id, seconds, overran):
+        l = self.latency.get(peer_id)
+        if l is None:
+            l = self.latency[peer_id] = [0, 0.0, 0.0, 0]
+        l[0] += 1
+        l[1] += seconds
+        l[2] = max(l[2], seconds)
+        l[3] += overran
+        self.round_overruns += overran
+
+    def run(self, calls):
+        """
+        calls: list of (peer_id, f, args)
+        Returns the list of f(*args), with [] for the calls that ran over.
+        """
+        results = []
+        for (peer_id, f, args) in calls:
+            (result, seconds, overran) = call_with_deadline(f, args, self.deadline)
+            self.record(peer_id, seconds, overran)
+            results.append(result)
+        return results
+
+    def start_round(self, peer_info):
+        """Called at the start of each round, before any requests"""
+        self.round_overruns = 0
+
+    def requests(self, agents, views, histories, pieces):
+        """Each agent's requests(), after giving it its copy of pieces"""
+        def ask(a, pieces, peers, history):
+            a.update_pieces(pieces)
+            return a.requests(peers, history)
+        return self.run([(a.id, ask, (a, ps, v, h))
+                         for (a, ps, v, h) in zip(agents, pieces, views, histories)])
+
+    def uploads(self, agents, requests, views, histories):
+        """Each agent's uploads()"""
+        return self.run([(a.id, a.uploads, (rs, v, h))
+                         for (a, rs, v, h) in zip(agents, requests, views, histories)])
+
+    def end_round(self, downloads, uploads):
+        """Called with what happened once the round is over"""
+        pass
+
+    def close(self):
+        pass
+
+
+class WorkerThread:
+    """
+    A daemon thread that runs calls one at a time.  Daemon, so a call that
+    never returns doesn't keep the sim from exiting.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (fut, f, args) = item
+            try:
+                fut.set_result((f(*args), time.perf_counter()))
+            except Exception as e:
+                fut.set_exception(e)
+
+    def submit(self, f, args):
+        """Queue f(*args).  The future gets (result, when it finished)."""
+        fut = concurrent.futures.Future()
+        self.queue.put((fut, f, args))
+        return fut
+
+    def stop(self):
+        self.queue.put(None)
+
+
+class ThreadDriver(Driver):
+    """
+    Runs the calls on a pool of config.driver_workers threads.  Every call
+    is handed over when the round asks for it, and its deadline runs from
+    then, including any wait for a free thread: a call still waiting when
+    its time is up never runs.  A call that overruns is left to finish on
+    its thread, which leaves the pool (a new one takes its place, so stuck
+    threads never cost the pool any room) and is retired once it's done.
+    Until then that agent's calls are skipped, and count as overruns.
+    """
+    def __init__(self, config):
+        self.deadline = config.deadline
+        self.latency = dict()
+        self.round_overruns = 0
+        self.size = config.driver_workers
+        self.live = 0        # threads in the pool, free or running a call
+        self.free = []       # threads in the pool with nothing to do
+        # future of a call that overran and is still going -> its thread
+        self.stuck = dict()
+        # peer_id -> future of a call that overran and is still going
+        self.busy = dict()
+
+    def free_thread(self):
+        """A free thread from the pool, or None if they're all busy"""
+        if self.free:
+            return self.free.pop()
+        if self.live < self.size:
+            self.live += 1
+            return WorkerThread()
+        return None
+
+    def run(self, calls):
+        deadline = self.deadline
+        for (fut, t) in list(self.stuck.items()):
+            if fut.done():
+                del self.stuck[fut]
+                t.stop()
+
+        results = [[] for c in calls]
+        waiting = collections.deque()   # (call number, peer_id, f, args)
+        for (i, (peer_id, f, args)) in enumerate(calls):
+            prev = self.busy.get(peer_id)
+            if prev is not None:
+                if not prev.done():
+                    self.record(peer_id, 0.0, True)
+                    continue
+                del self.busy[peer_id]
+            waiting.append((i, peer_id, f, args))
+
+        # Everything was handed over just now
+        submitted = time.perf_counter()
+        running = dict()   # future -> (call number, peer_id, thread)
+        while waiting or running:
+            while waiting:
+                t = self.free_thread()
+                if t is None:
+                    break
+                (i, peer_id, f, args) = waiting.popleft()
+                running[t.submit(f, args)] = (i, peer_id, t)
+
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, submitted + deadline - time.perf_counter())
+            (done, _) = concurrent.futures.wait(
+                running, timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                (i, peer_id, t) = running.pop(fut)
+                self.free.append(t)
+                (result, finished) = fut.result()
+                seconds = finished - submitted
+                overran = deadline is not None and seconds > deadline
+                if not overran:
+                    results[i] = result
+                self.record(peer_id, seconds, overran)
+
+            if deadline is not None:
+                now = time.perf_counter()
+                if now - submitted >= deadline:
+                    for (fut, (i, peer_id, t)) in running.items():
+                        self.stuck[fut] = t
+                        self.live -= 1
+                        self.busy[peer_id] = fut
+                        self.record(peer_id, now - submitted, True)
+                    for (i, peer_id, f, args) in waiting:
+                        self.record(peer_id, now - submitted, True)
+                    break
+        return results
+
+    def close(self):
+        # Don't wait for calls that overran
+        for t in self.free + list(self.stuck.values()):
+            t.stop()
+
+
+class ProcessDriver(Driver):
+    """
+    Splits the agents between worker processes, which keep them for the
+    whole run.  Each worker keeps its own copy of the History, updated at
+    the end of every round, so its agents get the usual AgentHistory.
+    The agent objects in the sim's process don't see any of the agents'
+    changes to themselves.
+    """
+    def __init__(self, config, agents, peer_ids, upload_rates, peer_index,
+                 neighbor_index):
+        Driver.__init__(self, config)
+        n = min(config.driver_workers, len(agents)) or 1
+        self.worker_of = dict()   # peer_id -> worker number
+        groups = [[] for i in range(n)]
+        for (j, a) in enumerate(agents):
+            self.worker_of[a.id] = j % n
+            groups[j % n].append(a)
+
+        self.conns = []
+        self.procs = []
+        for group in groups:
+            (conn, child) = multiprocessing.Pipe()
+            p = multiprocessing.Process(
+                target=agent_worker,
+                args=(child, group, peer_ids, upload_rates, peer_index,
+                      neighbor_index, config.deadline, random.getrandbits(64)))
+            p.daemon = True
+            p.start()
+            child.close()
+            self.conns.append(conn)
+            self.procs.append(p)
+
+    def send_all(self, msg):
+        for conn in self.conns:
+            conn.send(msg)
+
+    def ask_all(self, kind, items):
+        """
+        items: list of (peer_id, arg).  Sends each to its agent's worker,
+        and returns the results in the same order.
+        """
+        per_worker = [[] for c in self.conns]
+        for (k, (peer_id, arg)) in enumerate(items):
+            per_worker[self.worker_of[peer_id]].append((k, peer_id, arg))
+        for (conn, batch) in zip(self.conns, per_worker):
+            conn.send((kind, [(peer_id, arg) for (k, peer_id, arg) in batch]))
+        results = [None] * len(items)
+        for (conn, batch) in zip(self.conns, per_worker):
+            reply = conn.recv()
+            if reply[0] == "error":
+                raise RuntimeError("Agent failed in worker process:\n%s" % reply[1])
+            for ((k, peer_id, arg), (result, seconds, overran)) in zip(batch, reply[1]):
+                self.record(peer_id, seconds, overran)
+                results[k] = result
+        return results
+
+    def start_round(self, peer_info):
+        Driver.start_round(self, peer_info)
+        self.send_all(("round", peer_info))
+
+    # Each call carries the piece counts its agent sees, which under a
+    # topology differ from agent to agent
+    def requests(self, agents, views, histories, pieces):
+        return self.ask_all("requests", [
+            (a.id, (ps, array('i', h.piece_counts)))
+            for (a, ps, h) in zip(agents, pieces, histories)])
+
+    def uploads(self, agents, requests, views, histories):
+        return self.ask_all("uploads", [
+            (a.id, (rs, array('i', h.piece_counts)))
+            for (a, rs, h) in zip(agents, requests, histories)])
+
+    def end_round(self, downloads, uploads):
+        self.send_all(("history", downloads, uploads))
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(("stop",))
+            except (OSError, EOFError):
+                pass
+        for p in self.procs:
+            # Workers are idle between calls, unless one is stuck in an
+            # agent with no deadline to stop it
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+
+
+def agent_worker(conn, agents, peer_ids, upload_rates, peer_index,
+                 neighbor_index, deadline, seed):
+    """Main loop of a ProcessDriver worker"""
+    random.seed(seed)
+    if deadline is not None:
+        install_alarm()
+    history = History(peer_ids, upload_rates)
+    by_id = dict((a.id, a) for a in agents)
+    peer_info = None
+
+    def view(peer_id):
+        if neighbor_index is None:
+            return PeerView(peer_info, peer_index[peer_id])
+        return NeighborView(peer_info, neighbor_index[peer_id])
+
+    while True:
+        msg = conn.recv()
+        kind = msg[0]
+        try:
+            if kind == "round":
+                peer_info = msg[1]
+            elif kind == "history":
+                history.update(msg[1], msg[2])
+            elif kind == "requests":
+                out = []
+                for (peer_id, (pieces, piece_counts)) in msg[1]:
+                    a = by_id[peer_id]
+                    a.update_pieces(pieces)
+                    h = history.peer_history(
+                        peer_id, memoryview(piece_counts).toreadonly())
+                    out.append(call_with_deadline(a.requests, (view(peer_id), h),
+                                                  deadline))
+                conn.send(("ok", out))
+            elif kind == "uploads":
+                out = []
+                for (peer_id, (requests, piece_counts)) in msg[1]:
+                    a = by_id[peer_id]
+                    h = history.peer_history(
+                        peer_id, memoryview(piece_counts).toreadonly())
+                    out.append(call_with_deadline(a.uploads,
+                                                  (requests, view(peer_id), h),
+                                                  deadline))
+                conn.send(("ok", out))
+            elif kind == "stop":
+                break
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+            break
+    conn.close()
+
+
+def make_driver(config, agents, peer_ids, upload_rates, peer_index,
+                neighbor_index):
+    """The driver config.driver asks for, for the given agents"""
+    if config.driver == "serial":
+        return Driver(config)
+    elif config.driver == "thread":
+        return ThreadDriver(config)
+    elif config.driver == "process":
+        return ProcessDriver(config, agents, peer_ids, upload_rates,
+                             peer_index, neighbor_index)
+    raise ValueError("Unknown driver: %s (choose from %s)" % (
+        config.driver, ", ".join(DRIVERS)))
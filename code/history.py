@@ -1,7 +1,17 @@
 #!/usr/bin/python
 
 import copy
+import json
+import mmap
+import os
+import pickle
 import pprint
+import sys
+import tempfile
+from array import array
+from types import MappingProxyType
+
+from messages import Upload, Download
 
 
 class AgentHistory:
@@ -14,14 +24,48 @@ class AgentHistory:
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
 
+    Both are read-only RoundsViews into the History; indexing them by round
+    gives a fresh list.
+
+    history.piece_counts: piece_counts[i] is how many peers in the swarm have
+         piece i right now (read-only).  Under a topology, only this agent's
+         neighbors are counted.  Use util.rarest_first to order pieces by it.
+
+    Each agent gets the same AgentHistory every round, so it's a fine place
+    to keep anything derived from the history that's worth carrying over.
+
+    Totals of the downloads, kept up to date as rounds are added, so they
+    cost nothing to look at (all read-only dicts: peer_id -> blocks):
+
+    history.received(r): blocks this agent got from each peer in round r
+    history.received_recent(k): same, summed over the last k rounds (once
+         per round, the first time it's asked for)
+    history.received_total(): same, over all rounds so far
+    history.given_total(): blocks each peer has got from this agent
+
     """
-    def __init__(self, peer_id, downloads, uploads):
+    def __init__(self, peer_id, downloads, uploads, piece_counts=None,
+                 ledger=None):
         """
         Pull out just the info for peer_id.
         """
         self.uploads = uploads
         self.downloads = downloads
         self.peer_id = peer_id
+        self.piece_counts = piece_counts
+        self.ledger = ledger
+
+    def received(self, r):
+        return self.ledger.received(r)
+
+    def received_recent(self, k):
+        return self.ledger.received_recent(k)
+
+    def received_total(self):
+        return MappingProxyType(self.ledger.received_total)
+
+    def given_total(self):
+        return MappingProxyType(self.ledger.given_total)
 
     def last_round(self):
         return len(self.downloads)-1
@@ -32,13 +76,141 @@ class AgentHistory:
 
     def __repr__(self):
         return "AgentHistory(downloads=%s, uploads=%s)" % (
-            pprint.pformat(self.downloads),
-            pprint.pformat(self.uploads))
+            pprint.pformat(list(self.downloads)),
+            pprint.pformat(list(self.uploads)))
+
+
+def _number(x):
+    """Blocks and bandwidths are stored as doubles; give back ints where
+    that's what they were."""
+    return int(x) if x.is_integer() else x
+
+
+class RoundsView:
+    """
+    Read-only list-like view of one peer's downloads or uploads in a History.
+
+    view[r] builds the list of Download (or Upload) objects for round r from
+    the History's columns.  The view grows as rounds are added.
+    """
+    def __init__(self, history, make_round, index):
+        self.history = history
+        self.make_round = make_round
+        self.index = index
+
+    def __len__(self):
+        return self.history.num_rounds
+
+    def __getitem__(self, r):
+        n = len(self)
+        if isinstance(r, slice):
+            return [self.make_round(self.index, i) for i in range(*r.indices(n))]
+        if r < 0:
+            r += n
+        if r < 0 or r >= n:
+            raise IndexError("round index out of range")
+        return self.make_round(self.index, r)
+
+    def __iter__(self):
+        for r in range(len(self)):
+            yield self.make_round(self.index, r)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class PeerLedger:
+    """
+    One peer's download totals in a History (see AgentHistory for what's
+    in it), updated by History.update.
+
+    rounds[r] is a dict: peer_id -> blocks received from it in round r, or
+    None once round r has been spilled (it's then rebuilt from the spill
+    file if asked for).  windows maps k -> the sum of the last k rounds,
+    for each k asked for since the last round was added.  Windows are
+    summed afresh each round rather than slid along by adding the new
+    round and taking off the old: blocks can be fractional, and float
+    sums that went up and back down don't come back to exactly 0.
+    """
+    EMPTY = {}   # shared by all the rounds with no downloads; never changed
+
+    def __init__(self, history, index):
+        self.history = history
+        self.index = index
+        self.rounds = []
+        self.received_total = dict()
+        self.given_total = dict()
+        self.windows = dict()
+
+    def round_dict(self, r):
+        d = self.rounds[r]
+        if d is None:
+            d = dict()
+            for dl in self.history.downloads_for_round(self.index, r):
+                d[dl.from_id] = d.get(dl.from_id, 0) + dl.blocks
+        return d
+
+    def received(self, r):
+        return MappingProxyType(self.round_dict(r))
+
+    def received_recent(self, k):
+        w = self.windows.get(k)
+        if w is None:
+            w = self.windows[k] = dict()
+            for r in range(max(0, len(self.rounds) - k), len(self.rounds)):
+                add_blocks(w, self.round_dict(r))
+        return MappingProxyType(w)
+
+    def add_round(self, d):
+        """d: peer_id -> blocks received from it in the new round"""
+        self.rounds.append(d if d else self.EMPTY)
+        if d:
+            add_blocks(self.received_total, d)
+        self.windows.clear()
+
+
+def add_blocks(totals, d):
+    """totals[pid] += d[pid] for each pid in d, dropping zeros"""
+    for (pid, blocks) in d.items():
+        t = totals.get(pid, 0) + blocks
+        if t == 0:
+            del totals[pid]
+        else:
+            totals[pid] = t
+
+
+# History's column names, downloads then uploads
+DL_COLUMNS = ("dl_round", "dl_from", "dl_to", "dl_piece", "dl_blocks")
+UL_COLUMNS = ("ul_round", "ul_from", "ul_to", "ul_bw")
+
+# First bytes of a file written by History.save
+SAVE_MAGIC = b"BTHIST01"
+
+
+class RoundColumns:
+    """
+    The columns of a run of rounds starting at first_round, laid out like
+    History's own (offsets count from the first of them).  Rounds a History
+    has spilled to disk come back as these.
+    """
+    def __init__(self, first_round):
+        self.first_round = first_round
+        self.dl_round = array('i')
+        self.dl_from = array('i')
+        self.dl_to = array('i')
+        self.dl_piece = array('i')
+        self.dl_blocks = array('d')
+        self.dl_offsets = array('q', [0])
+        self.ul_round = array('i')
+        self.ul_from = array('i')
+        self.ul_to = array('i')
+        self.ul_bw = array('d')
+        self.ul_offsets = array('q', [0])
 
 
 class History:
     """History of the whole sim"""
-    def __init__(self, peer_ids, upload_rates):
+    def __init__(self, peer_ids, upload_rates, window=None, spill_dir=None):
         """
         uploads:
                    dict : peer_id -> [[uploads] -- one list per round]
@@ -47,13 +219,84 @@ class History:
                    
         Keep track of the uploads _from_ and downloads _to_ the
         specified peer id.
+
+        Both are views: the messages themselves are stored column-wise in
+        typed arrays, one entry per download or upload:
+            dl_round, dl_from, dl_to, dl_piece, dl_blocks
+            ul_round, ul_from, ul_to, ul_bw
+        Peer ids are stored as indexes into self.names.  dl_offsets[k] is
+        where the downloads of peer k % P in round k // P start (P peers),
+        and likewise ul_offsets.
+
+        window: if set, only keep the last window rounds in memory.  Older
+        rounds get appended to a spill file in spill_dir (default: the
+        system temp dir) and are read back from it when asked for, so the
+        stats and pretty() still see everything.  Once rounds have been
+        spilled, round r's offsets are at (r - first_round) * P.  Call
+        close() to delete the spill file.
         """
         self.upload_rates = upload_rates  # peer_id -> up_bw
         self.peer_ids = peer_ids[:]
 
         self.round_done = dict()   # peer_id -> round finished
-        self.downloads = dict((pid, []) for pid in peer_ids)
-        self.uploads = dict((pid, []) for pid in peer_ids)
+        # Running totals, kept up to date by update(), so the end-of-run
+        # stats don't have to go back over every download:
+        # peer_id -> blocks uploaded (i.e. downloaded from it)
+        self.uploaded = dict((pid, 0.0) for pid in peer_ids)
+        # the latest round in round_done
+        self.last_done = None
+        # peer_id -> rounds its requests and uploads weren't validated
+        self.unchecked = dict((pid, 0) for pid in peer_ids)
+        # peer_id -> [calls, total seconds, slowest call, calls over the
+        # deadline], if the agents were run through a driver (see drivers.py)
+        self.latency = dict()
+
+        self.names = peer_ids[:]   # index -> peer_id
+        self.index = dict((pid, i) for i, pid in enumerate(self.names))
+        self.num_rounds = 0
+
+        self.window = window
+        self.spill_dir = spill_dir
+        self.spill_path = None
+        self.spill_offsets = []   # round -> where it starts in the spill file
+        self.first_round = 0      # first round still in memory
+        self._spill = None        # open spill file
+        self._loaded = None       # last RoundColumns read back from it
+        self._mmap = None         # file backing a History from load()
+
+        self.dl_round = array('i')
+        self.dl_from = array('i')
+        self.dl_to = array('i')
+        self.dl_piece = array('i')
+        self.dl_blocks = array('d')
+        self.dl_offsets = array('q', [0])
+
+        self.ul_round = array('i')
+        self.ul_from = array('i')
+        self.ul_to = array('i')
+        self.ul_bw = array('d')
+        self.ul_offsets = array('q', [0])
+
+        self.downloads = dict(
+            (pid, RoundsView(self, self.downloads_for_round, i))
+            for i, pid in enumerate(self.peer_ids))
+        self.uploads = dict(
+            (pid, RoundsView(self, self.uploads_for_round, i))
+            for i, pid in enumerate(self.peer_ids))
+        # peer_id -> AgentHistory, made by peer_history the first time
+        self.agent_histories = dict()
+        # peer_id -> PeerLedger.  None for a History from load().
+        self.ledgers = dict((pid, PeerLedger(self, i))
+                            for i, pid in enumerate(self.peer_ids))
+
+    def id_index(self, peer_id):
+        """Index of peer_id in self.names, adding it if it's new (uploads
+        aren't checked for bogus to_ids)."""
+        i = self.index.get(peer_id)
+        if i is None:
+            i = self.index[peer_id] = len(self.names)
+            self.names.append(peer_id)
+        return i
 
     def update(self, dls, ups):
         """
@@ -62,43 +305,300 @@ class History:
 
         append these downloads to to the history
         """
+        r = self.num_rounds
+        idx = self.id_index
+        uploaded = self.uploaded
+        ledgers = self.ledgers
         for pid in self.peer_ids:
-            self.downloads[pid].append(dls[pid])
-            self.uploads[pid].append(ups[pid])
+            received = dict()
+            for d in dls[pid]:
+                uploaded[d.from_id] = uploaded.get(d.from_id, 0.0) + d.blocks
+                received[d.from_id] = received.get(d.from_id, 0) + d.blocks
+                giver = ledgers.get(d.from_id)
+                if giver is not None:
+                    giver.given_total[pid] = giver.given_total.get(pid, 0) + d.blocks
+                self.dl_round.append(r)
+                self.dl_from.append(idx(d.from_id))
+                self.dl_to.append(idx(d.to_id))
+                self.dl_piece.append(d.piece)
+                self.dl_blocks.append(d.blocks)
+            self.dl_offsets.append(len(self.dl_round))
+
+            for u in ups[pid]:
+                self.ul_round.append(r)
+                self.ul_from.append(idx(u.from_id))
+                self.ul_to.append(idx(u.to_id))
+                self.ul_bw.append(u.bw)
+            self.ul_offsets.append(len(self.ul_round))
+            ledgers[pid].add_round(received)
+        self.num_rounds += 1
+
+        if self.window is not None:
+            while self.num_rounds - self.first_round > self.window:
+                self.spill_round()
+
+    def add_idle_rounds(self, n):
+        """Add n rounds where nothing happened."""
+        nothing = dict((pid, ()) for pid in self.peer_ids)
+        for i in range(n):
+            self.update(nothing, nothing)
+
+    def spill_file(self):
+        """The spill file, opened for reading and appending"""
+        if self._spill is None:
+            if self.spill_path is None:
+                fd, self.spill_path = tempfile.mkstemp(
+                    prefix="history-", suffix=".spill", dir=self.spill_dir)
+                self._spill = os.fdopen(fd, "w+b")
+            else:
+                self._spill = open(self.spill_path, "r+b")
+        return self._spill
+
+    def spill_round(self):
+        """Move the oldest round in memory to the end of the spill file."""
+        P = len(self.peer_ids)
+        chunk = RoundColumns(self.first_round)
+        for (columns, offsets_name) in ((DL_COLUMNS, "dl_offsets"),
+                                        (UL_COLUMNS, "ul_offsets")):
+            offsets = getattr(self, offsets_name)
+            n = offsets[P]
+            for name in columns:
+                column = getattr(self, name)
+                setattr(chunk, name, column[:n])
+                del column[:n]
+            setattr(chunk, offsets_name, offsets[:P+1])
+            setattr(self, offsets_name, array('q', (x - n for x in offsets[P:])))
+
+        f = self.spill_file()
+        f.seek(0, os.SEEK_END)
+        self.spill_offsets.append(f.tell())
+        pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+        for ledger in self.ledgers.values():
+            ledger.rounds[self.first_round] = None
+        self.first_round += 1
+
+    def round_columns(self, r):
+        """Columns holding round r: self if it's still in memory, otherwise
+        a RoundColumns read back from the spill file."""
+        if r >= self.first_round:
+            return self
+        if self._loaded is None or self._loaded.first_round != r:
+            f = self.spill_file()
+            f.flush()
+            f.seek(self.spill_offsets[r])
+            self._loaded = pickle.load(f)
+        return self._loaded
+
+    def chunks(self):
+        """Yield columns covering every round in order: the spilled ones a
+        round at a time, then the ones in memory."""
+        for r in range(self.first_round):
+            yield self.round_columns(r)
+        yield self
+
+    def save(self, filename):
+        """
+        Write the whole history (spilled rounds included) to filename, for
+        History.load to map back in.  The file is:
+            SAVE_MAGIC, 8-byte little-endian header length, JSON header,
+            then each column's raw bytes (native byte order), 8-byte aligned.
+        The header has the peers, upload_rates, round_done, unchecked,
+        uploaded, the number of rounds, and where each column is: name -> [typecode,
+        byte offset, length].
+        """
+        columns = DL_COLUMNS + ("dl_offsets",) + UL_COLUMNS + ("ul_offsets",)
+        chunks = list(self.chunks())
+
+        def pieces(name):
+            """Yield the arrays making up the full column name"""
+            if not name.endswith("_offsets"):
+                for c in chunks:
+                    yield getattr(c, name)
+                return
+            # Offsets restart at 0 in each chunk; shift them to count from
+            # the start of the whole column.
+            base = 0
+            first = True
+            for c in chunks:
+                offsets = getattr(c, name)
+                yield array('q', (base + x for x in (offsets if first else offsets[1:])))
+                base += offsets[-1]
+                first = False
+
+        layout = dict()
+        pos = 0
+        for name in columns:
+            n = sum(len(a) for a in pieces(name))
+            typecode = getattr(self, name).typecode
+            layout[name] = [typecode, pos, n]
+            pos += -(-n * array(typecode).itemsize // 8) * 8
+
+        header = json.dumps(dict(
+            byteorder=sys.byteorder,
+            peer_ids=self.peer_ids,
+            names=self.names,
+            upload_rates=self.upload_rates,
+            round_done=self.round_done,
+            unchecked=self.unchecked,
+            uploaded=self.uploaded,
+            num_rounds=self.num_rounds,
+            columns=layout)).encode()
+        start = len(SAVE_MAGIC) + 8 + len(header)
+        start += -start % 8
+
+        with open(filename, "wb") as f:
+            f.write(SAVE_MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            f.write(b"\0" * (start - f.tell()))
+            for name in columns:
+                for a in pieces(name):
+                    a.tofile(f)
+                f.write(b"\0" * (-f.tell() % 8))
+
+    @staticmethod
+    def load(filename):
+        """
+        Map a file written by save() back in as a History.  The columns are
+        read-only memoryviews into the file, so only the parts that get
+        looked at are read.  Works with Stats and pretty(), but can't be
+        update()d, and has no ledgers for AgentHistory.
+        """
+        with open(filename, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if m[:len(SAVE_MAGIC)] != SAVE_MAGIC:
+            m.close()
+            raise ValueError("%s isn't a saved History" % filename)
+        size = int.from_bytes(m[len(SAVE_MAGIC):len(SAVE_MAGIC)+8], "little")
+        header_start = len(SAVE_MAGIC) + 8
+        header = json.loads(m[header_start:header_start+size].decode())
+        if header["byteorder"] != sys.byteorder:
+            m.close()
+            raise ValueError("%s was saved with %s-endian byte order" % (
+                filename, header["byteorder"]))
+        start = header_start + size
+        start += -start % 8
+
+        h = History(header["peer_ids"], header["upload_rates"])
+        h.names = header["names"]
+        h.index = dict((pid, i) for i, pid in enumerate(h.names))
+        h.round_done = header["round_done"]
+        h.unchecked = header["unchecked"]
+        h.uploaded = header["uploaded"]
+        h.last_done = max(h.round_done.values(), default=None)
+        h.ledgers = None
+        h.num_rounds = header["num_rounds"]
+        view = memoryview(m)
+        for name, (typecode, pos, n) in header["columns"].items():
+            itemsize = array(typecode).itemsize
+            setattr(h, name, view[start+pos:start+pos+n*itemsize].cast(typecode))
+        h._mmap = m
+        return h
+
+    def close(self):
+        """Delete the spill file, if there is one.  Spilled rounds are gone
+        after this.  For a History from load(), unmaps the file."""
+        if self._mmap is not None:
+            for name in DL_COLUMNS + UL_COLUMNS + ("dl_offsets", "ul_offsets"):
+                getattr(self, name).release()
+            self._mmap.close()
+            self._mmap = None
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self.spill_path is not None:
+            os.remove(self.spill_path)
+            self.spill_path = None
+
+    def __getstate__(self):
+        # Open files don't pickle; the copy reopens the spill file by name.
+        if self._spill is not None:
+            self._spill.flush()
+        state = self.__dict__.copy()
+        state["_spill"] = None
+        state["_loaded"] = None
+        # The cached AgentHistories hold the sim's piece_counts memoryview,
+        # which doesn't pickle; peer_history makes new ones as needed.
+        state["agent_histories"] = dict()
+        return state
+
+    def downloads_for_round(self, i, r):
+        """List of Download objects to peer number i in round r"""
+        c = self.round_columns(r)
+        k = (r - c.first_round) * len(self.peer_ids) + i
+        names = self.names
+        return [Download(names[c.dl_from[j]], names[c.dl_to[j]],
+                         c.dl_piece[j], _number(c.dl_blocks[j]))
+                for j in range(c.dl_offsets[k], c.dl_offsets[k+1])]
+
+    def uploads_for_round(self, i, r):
+        """List of Upload objects from peer number i in round r"""
+        c = self.round_columns(r)
+        k = (r - c.first_round) * len(self.peer_ids) + i
+        names = self.names
+        return [Upload(names[c.ul_from[j]], names[c.ul_to[j]],
+                       _number(c.ul_bw[j]))
+                for j in range(c.ul_offsets[k], c.ul_offsets[k+1])]
 
     def peer_is_done(self, round, peer_id):
         # Only save the _first_ round where we hear this
         if peer_id not in self.round_done:
             self.round_done[peer_id] = round
+            if self.last_done is None or round > self.last_done:
+                self.last_done = round
 
-    def peer_history(self, peer_id):
-        return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id])
+    def peer_history(self, peer_id, piece_counts=None):
+        """
+        The AgentHistory for peer_id.  It's the same object every round:
+        its views and ledger grow as rounds are added, so only piece_counts
+        needs setting.
+        """
+        ah = self.agent_histories.get(peer_id)
+        if ah is None:
+            ah = self.agent_histories[peer_id] = AgentHistory(
+                peer_id, self.downloads[peer_id], self.uploads[peer_id],
+                piece_counts, self.ledgers and self.ledgers[peer_id])
+        else:
+            ah.piece_counts = piece_counts
+        return ah
 
     def last_round(self):
         """index of the last completed round"""
-        p = self.peer_ids[0]
-        return len(self.downloads[p])-1
+        return self.num_rounds-1
+
+    def pretty_lines_for_round(self, r):
+        """Yield the lines of pretty_for_round(r), read straight off the
+        download columns."""
+        yield "\nRound %s:\n" % r
+        names = self.names
+        P = len(self.peer_ids)
+        c = self.round_columns(r)
+        for i, peer_id in enumerate(self.peer_ids):
+            k = (r - c.first_round) * P + i
+            for j in range(c.dl_offsets[k], c.dl_offsets[k+1]):
+                yield "%s downloaded %d blocks of piece %d from %s\n" % (
+                    peer_id, c.dl_blocks[j], c.dl_piece[j],
+                    names[c.dl_from[j]])
+
+    def pretty_lines(self):
+        """Yield the lines of pretty(), one round at a time, so the whole
+        history can be written to a stream without building one big string."""
+        yield "History\n"
+        for r in range(self.last_round()+1):
+            for line in self.pretty_lines_for_round(r):
+                yield line
 
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
-        for peer_id in self.peer_ids:
-            ds = self.downloads[peer_id][r]
-            stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
-                peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+        return "".join(self.pretty_lines_for_round(r))
 
     def pretty(self):
-        s = "History\n"
-        for r in range(self.last_round()+1):
-            s += self.pretty_for_round(r)
-        return s
+        return "".join(self.pretty_lines())
 
     def __repr__(self):
         return """History(
 uploads=%s
 downloads=%s
 )""" % (
-    pprint.pformat(self.uploads),
-    pprint.pformat(self.downloads))
+    pprint.pformat(dict((pid, list(v)) for pid, v in self.uploads.items())),
+    pprint.pformat(dict((pid, list(v)) for pid, v in self.downloads.items())))
 
@@ -1,6 +1,14 @@
 #!/usr/bin/python
 
+from collections.abc import MutableSequence
+
+# Every round creates lots of Uploads, Requests and Downloads, and the
+# History keeps them all, so they use __slots__ rather than a per-instance
+# __dict__.
+
 class Upload:
+    __slots__ = ('from_id', 'to_id', 'bw')
+
     def __init__(self, from_id, to_id, up_bw):
         self.from_id = from_id
         self.to_id = to_id
@@ -11,6 +19,8 @@ class Upload:
             self.from_id, self.to_id, self.bw)
 
 class Request:
+    __slots__ = ('requester_id', 'peer_id', 'piece_id', 'start')
+
     def __init__(self, requester_id, peer_id, piece_id, start):
         self.requester_id = requester_id
         self.peer_id = peer_id   # peer data is requested from
@@ -25,6 +35,8 @@ class Download:
     """ Not actually a message--just used for accounting and history tracking of
      what is actually downloaded.
     """
+    __slots__ = ('from_id', 'to_id', 'piece', 'blocks')
+
     def __init__(self, from_id, to_id, piece, blocks):
         self.from_id = from_id  # who did the agent download from?
         self.to_id = to_id      # Who downloaded?
@@ -42,11 +54,118 @@ class PeerInfo:
     """
     Only passing peer ids and the pieces they have available to each agent.
     This prevents them from accidentally messing up the state of other agents.
+
+    available_pieces is an immutable PieceSet (see pieces.py).
+
+    The sim reuses a PeerInfo for as long as the peer's pieces don't change,
+    and hands the same one to every agent, so they're read-only.
     """
+    __slots__ = ('id', 'available_pieces')
+
     def __init__(self, id, available):
-        self.id = id
-        self.available_pieces = available
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'available_pieces', available)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PeerInfo is read-only")
+
+    def __reduce__(self):
+        return (PeerInfo, (self.id, self.available_pieces))
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
 
+
+class PeerView(MutableSequence):
+    """
+    The PeerInfos of every peer but one: what an agent gets as its peers.
+
+    Reads go straight to a tuple of PeerInfos shared by every agent in the
+    round, so making one costs nothing.  The first change to it (e.g.
+    peers.sort()) copies the other peers into a private list, so an agent
+    can only ever reorder its own view.
+    """
+    __slots__ = ('shared', 'skip', 'own')
+
+    def __init__(self, shared, skip):
+        """
+        shared: tuple of PeerInfo for all the peers
+        skip: index in shared of the peer this view is for
+        """
+        self.shared = shared
+        self.skip = skip
+        self.own = None
+
+    def _own(self):
+        if self.own is None:
+            self.own = list(self)
+        return self.own
+
+    def __len__(self):
+        if self.own is not None:
+            return len(self.own)
+        return len(self.shared) - 1
+
+    def __getitem__(self, i):
+        if self.own is not None:
+            return self.own[i]
+        if isinstance(i, slice):
+            return list(self)[i]
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("PeerView index out of range")
+        return self.shared[i if i < self.skip else i + 1]
+
+    def __iter__(self):
+        if self.own is not None:
+            return iter(self.own)
+        return (p for (j, p) in enumerate(self.shared) if j != self.skip)
+
+    def __setitem__(self, i, value):
+        self._own()[i] = value
+
+    def __delitem__(self, i):
+        del self._own()[i]
+
+    def insert(self, i, value):
+        self._own().insert(i, value)
+
+    def sort(self, key=None, reverse=False):
+        self._own().sort(key=key, reverse=reverse)
+
+    def copy(self):
+        return list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class NeighborView(PeerView):
+    """
+    A PeerView of just some of the peers -- an agent's neighbors when the sim
+    has a topology -- given by their indexes in the shared tuple.
+    """
+    __slots__ = ('indices',)
+
+    def __init__(self, shared, indices):
+        PeerView.__init__(self, shared, None)
+        self.indices = indices
+
+    def __len__(self):
+        if self.own is not None:
+            return len(self.own)
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if self.own is not None:
+            return self.own[i]
+        if isinstance(i, slice):
+            return list(self)[i]
+        return self.shared[self.indices[i]]
+
+    def __iter__(self):
+        if self.own is not None:
+            return iter(self.own)
+        return (self.shared[j] for j in self.indices)
@@ -10,12 +10,15 @@ import random
 import logging
 
 from messages import Upload, Request
-from util import even_split
+from util import even_split, rarest_first
 from peer import Peer
+from pieces import PieceSet
 
 from math import floor
 
 class MMJWPropshare(Peer):
+    skip_when_idle = True
+
     def post_init(self):
         print(("post_init(): %s here!" % self.id))
         self.dummy_state = dict()
@@ -32,19 +35,20 @@ class MMJWPropshare(Peer):
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitmaps support fast intersection ops.
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        logging.debug("%s here: still need pieces %s",
+                      self.id, needed_pieces)
 
-        logging.debug("%s still here. Here are some peers:" % self.id)
-        for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+        logging.debug("%s still here. Here are some peers:", self.id)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for p in peers:
+                logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
@@ -55,27 +59,16 @@ class MMJWPropshare(Peer):
         peers.sort(key=lambda p: p.id)
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
-        piece_counts = {}
-        for peer in peers:
-            for piece_id in peer.available_pieces:
-                if not piece_id in piece_counts:
-                    piece_counts[piece_id] = 0
-                piece_counts[piece_id] += 1
-        rarest_first = list(piece_counts.items())[:]
-        random.shuffle(rarest_first)
-        rarest_first = sorted(rarest_first, key = lambda x: x[1])
+        piece_counts = history.piece_counts
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
+            isect = peer.available_pieces.intersection(np_set)
             n = min(self.max_requests, len(isect))
 
             # More symmetry breaking -- ask for random pieces.
             # This would be the place to try fancier piece-requesting strategies
             # to avoid getting the same thing from multiple peers at a time.
             cur_len = 0
-            cur_rarest = list(isect)
-            random.shuffle(cur_rarest)
-            cur_rarest.sort(key = lambda x: piece_counts[x])
+            cur_rarest = rarest_first(isect, piece_counts)
             for piece_id in cur_rarest:
                 if cur_len >= self.max_requests:
                     break
@@ -101,8 +94,8 @@ class MMJWPropshare(Peer):
         """
 
         round_num = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round_num))
+        logging.debug("%s again.  It's round %d.",
+                      self.id, round_num)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -121,12 +114,7 @@ class MMJWPropshare(Peer):
             OPTIM_UNCHOKE_RATIO = 0.1 # ratio of bw to use for optim unchoke
 
             # check previous round for who we downloaded from
-            prev_round_dt = history.downloads[round_num - 1]
-            prev_rnd_bw = {} # id |-> total size
-            for dl_obj in prev_round_dt:
-                if not dl_obj.from_id in prev_rnd_bw:
-                    prev_rnd_bw[dl_obj.from_id] = 0
-                prev_rnd_bw[dl_obj.from_id] += dl_obj.blocks
+            prev_rnd_bw = history.received(round_num - 1) # id |-> total size
             
             chosen_req_bw = {} # dict id -> total bw from prev. round
             optim_candidates = [] # for optimistic unchoking
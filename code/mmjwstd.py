@@ -10,10 +10,13 @@ import random
 import logging
 
 from messages import Upload, Request
-from util import even_split
+from util import even_split, rarest_first
 from peer import Peer
+from pieces import PieceSet
 
 class MMJWStd(Peer):
+    skip_when_idle = True
+
     def post_init(self):
         print(("post_init(): %s here!" % self.id))
         self.dummy_state = dict()
@@ -39,19 +42,20 @@ class MMJWStd(Peer):
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitmaps support fast intersection ops.
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        logging.debug("%s here: still need pieces %s",
+                      self.id, needed_pieces)
 
-        logging.debug("%s still here. Here are some peers:" % self.id)
-        for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+        logging.debug("%s still here. Here are some peers:", self.id)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for p in peers:
+                logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
@@ -62,27 +66,16 @@ class MMJWStd(Peer):
         peers.sort(key=lambda p: p.id)
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
-        piece_counts = {}
-        for peer in peers:
-            for piece_id in peer.available_pieces:
-                if not piece_id in piece_counts:
-                    piece_counts[piece_id] = 0
-                piece_counts[piece_id] += 1
-        rarest_first = list(piece_counts.items())[:]
-        random.shuffle(rarest_first)
-        rarest_first = sorted(rarest_first, key = lambda x: x[1])
+        piece_counts = history.piece_counts
         for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
+            isect = peer.available_pieces.intersection(np_set)
             n = min(self.max_requests, len(isect))
 
             # More symmetry breaking -- ask for random pieces.
             # This would be the place to try fancier piece-requesting strategies
             # to avoid getting the same thing from multiple peers at a time.
             cur_len = 0
-            cur_rarest = list(isect)
-            random.shuffle(cur_rarest)
-            cur_rarest.sort(key = lambda x: piece_counts[x])
+            cur_rarest = rarest_first(isect, piece_counts)
             for piece_id in cur_rarest:
                 if cur_len >= self.max_requests:
                     break
@@ -108,8 +101,8 @@ class MMJWStd(Peer):
         """
 
         round_num = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round_num))
+        logging.debug("%s again.  It's round %d.",
+                      self.id, round_num)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -137,11 +130,10 @@ class MMJWStd(Peer):
             cur_req_ids = list(set(map(lambda x: x.requester_id, requests)))
             prev_rnd_bw = dict(zip(cur_req_ids, [0] * len(cur_req_ids)))
 
-            for i in range(max(0, round_num - self.LOOKBACK_CNT), round_num):
-                for dl_obj in history.downloads[i]:
-                    if not dl_obj.from_id in prev_rnd_bw:
-                        continue
-                    prev_rnd_bw[dl_obj.from_id] += dl_obj.blocks
+            # blocks from each peer over the last LOOKBACK_CNT rounds
+            recent = history.received_recent(self.LOOKBACK_CNT)
+            for pid in prev_rnd_bw:
+                prev_rnd_bw[pid] += recent.get(pid, 0)
             candidates = list(prev_rnd_bw.items())
             random.shuffle(candidates)
             candidates.sort(key = lambda x: x[1], reverse=True)
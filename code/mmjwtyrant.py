@@ -10,8 +10,9 @@ import random
 import logging
 
 from messages import Upload, Request
-from util import even_split
+from util import even_split, rarest_first
 from peer import Peer
+from pieces import PieceSet
 
 class MMJWTyrant(Peer):
     def post_init(self):
@@ -39,19 +40,20 @@ class MMJWTyrant(Peer):
         """
         needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
         needed_pieces = list(filter(needed, list(range(len(self.pieces)))))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
+        np_set = PieceSet(needed_pieces)  # bitmaps support fast intersection ops.
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        logging.debug("%s here: still need pieces %s",
+                      self.id, needed_pieces)
 
-        logging.debug("%s still here. Here are some peers:" % self.id)
-        for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+        logging.debug("%s still here. Here are some peers:", self.id)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for p in peers:
+                logging.debug("id: %s, available pieces: %s", p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = []   # We'll put all the things we want here
         # Symmetry breaking is good...
@@ -62,25 +64,15 @@ class MMJWTyrant(Peer):
         peers.sort(key=lambda p: p.id)
         # request all available pieces from all peers!
         # (up to self.max_requests from each)
-        piece_count={}
-        for peer in peers:
-            for piece_id in peer.available_pieces:
-                if piece_id in piece_count.keys():
-                    piece_count[piece_id]+= 1
-                else:
-                    piece_count[piece_id]=1
-        
+        piece_count = history.piece_counts
+
         for peer in peers:
             i=0
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
-            isect_list = list(isect)
-            random.shuffle(isect_list)
+            isect = peer.available_pieces.intersection(np_set)
             # More symmetry breaking -- ask for random pieces.
             # This would be the place to try fancier piece-requesting strategies
             # to avoid getting the same thing from multiple peers at a time.
-            rarest_first=sorted(isect_list, key=lambda x: piece_count[x])
-            for piece_id in rarest_first:
+            for piece_id in rarest_first(isect, piece_count):
                 # aha! The peer has this piece! Request it.
                 # which part of the piece do we need next?
                 # (must get the next-needed blocks in order)
@@ -109,8 +101,8 @@ class MMJWTyrant(Peer):
         """
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.",
+                      self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -122,19 +114,15 @@ class MMJWTyrant(Peer):
                 self.record[peer.id] = 0
                 self.u[peer.id] = self.init_u
                 self.d[peer.id] = self.init_d
-                logging.info(str(self.record))
+                logging.info("%s", self.record)
         else:
             newrecord={}
             newd={}
 
             # Update records from previous round
-            for download in history.downloads[round-1]:
-                pid = download.from_id
+            for pid, blocks in history.received(round-1).items():
                 # NewD keeps track of the new values of d_{j}
-                if pid in newd:
-                    newd[pid] += download.blocks
-                else:
-                    newd[pid] = download.blocks
+                newd[pid] = blocks
                 # If you haven't already been updated
                 if not pid in newrecord:
                     # You haven't unchoked me for the past r rounds
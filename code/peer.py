@@ -5,6 +5,26 @@ from messages import Upload, Request
 from util import even_split
 
 class Peer:
+    # Set to True in a subclass to have the sim skip validating its requests
+    # and uploads.  Only for vetted strategies -- a bad request from a
+    # trusted peer can crash the sim.
+    trusted = False
+
+    # A subclass can make these classmethods taking a batch.Batch, to decide
+    # for all of its peers at once each round instead of through requests()
+    # and uploads().  See batch.py.
+    requests_batch = None
+    uploads_batch = None
+
+    # Set to True in a subclass whose requests() returns nothing once the peer
+    # has every piece, and whose uploads() returns nothing when there are no
+    # requests.  Those idle calls must change no state, the agent's own or
+    # the shared random module's (so no drawing random numbers), and the same
+    # goes for the batch methods when all of their agents are idle.  With
+    # --event-driven the sim then doesn't call them in those cases, and
+    # gives the same results as without.
+    skip_when_idle = False
+
     def __init__(self, config, id, init_pieces, up_bandwidth):
         self.conf = config
         self.id = id
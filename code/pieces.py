@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+import operator
+from array import array
+
+
+class PieceSet:
+    """
+    Immutable set of piece ids, stored as the bits of an int: piece i is in
+    the set if bit i is set.  Intersections are a single &, len is cached,
+    and iteration gives the pieces in increasing order.
+
+    Supports in, len, iteration and the usual set operations, so code
+    written for a set of piece ids works with it.  "Adding" a piece gives a
+    new PieceSet (see with_piece), so handing one out is always safe.
+    """
+    __slots__ = ('bits', 'count')
+
+    def __init__(self, pieces=()):
+        bits = 0
+        for i in pieces:
+            bits |= 1 << i
+        self.bits = bits
+        self.count = bits.bit_count()
+
+    @classmethod
+    def from_bits(cls, bits):
+        s = cls.__new__(cls)
+        s.bits = bits
+        s.count = bits.bit_count()
+        return s
+
+    def with_piece(self, i):
+        """This set plus piece i"""
+        return PieceSet.from_bits(self.bits | (1 << i))
+
+    def __contains__(self, i):
+        # Any integer type will do (e.g. numpy's), like with a set
+        try:
+            i = operator.index(i)
+        except TypeError:
+            return False
+        return i >= 0 and (self.bits >> i) & 1 == 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+    def _bits_of(self, other):
+        if isinstance(other, PieceSet):
+            return other.bits
+        return PieceSet(other).bits
+
+    def intersection(self, other):
+        return PieceSet.from_bits(self.bits & self._bits_of(other))
+
+    def union(self, other):
+        return PieceSet.from_bits(self.bits | self._bits_of(other))
+
+    def difference(self, other):
+        return PieceSet.from_bits(self.bits & ~self._bits_of(other))
+
+    __and__ = intersection
+    __or__ = union
+    __sub__ = difference
+
+    def isdisjoint(self, other):
+        return self.bits & self._bits_of(other) == 0
+
+    def __eq__(self, other):
+        if isinstance(other, PieceSet):
+            return self.bits == other.bits
+        if isinstance(other, (set, frozenset)):
+            return self == PieceSet(other)
+        return NotImplemented
+
+    def __hash__(self):
+        # Equal to the frozenset of the same pieces, so hash like it too
+        return hash(frozenset(self))
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __repr__(self):
+        # Print like a set, so logs look the same as they used to
+        if not self.bits:
+            return "set()"
+        return "{%s}" % ", ".join(str(i) for i in self)
+
+
+class PieceState:
+    """
+    Block counts for the whole sim.
+
+    state[peer_id][piece_id] -> number of blocks of that piece the peer has.
+
+    Each peer's row is a list that gets updated in place, so a round only
+    touches the rows of the peers that actually downloaded something.
+    Anything that hands a row to an agent must copy it first.
+
+    Also counts the completed pieces of each peer and the number of peers
+    that are done, so checking for completion doesn't need to scan rows, and
+    how many peers have each piece.  piece_counts is a read-only view of the
+    latter that can be handed straight to agents.
+
+    Under a topology (see count_neighbors), each peer also gets its own
+    counts over just its neighbors; counts_for gives the ones a peer should
+    see.
+    """
+    def __init__(self, peer_pieces, blocks_per_piece):
+        """
+        peer_pieces: dict : peer_id -> list (blocks / piece)
+        """
+        self.blocks_per_piece = blocks_per_piece
+        self.rows = dict((pid, list(pieces))
+                         for pid, pieces in peer_pieces.items())
+
+        self.completed = dict()  # peer_id -> number of finished pieces
+        self.num_done = 0
+        self.newly_done = []     # peers finished since the last pop_newly_done
+        num_pieces = max([len(row) for row in self.rows.values()] or [0])
+        self.counts = array('i', [0] * num_pieces)  # piece -> peers that have it
+        for pid, row in self.rows.items():
+            self.completed[pid] = sum(1 for b in row if b >= blocks_per_piece)
+            for i, b in enumerate(row):
+                if b >= blocks_per_piece:
+                    self.counts[i] += 1
+            if self.completed[pid] == len(row):
+                self.num_done += 1
+                self.newly_done.append(pid)
+        self.neighbors = None
+        self.local_counts = None  # peer_id -> counts over its neighbors
+        # Read-only views of the counts, made once: they follow the arrays
+        self.views = None
+        self.counts_view = memoryview(self.counts).toreadonly()
+
+    def count_neighbors(self, neighbors):
+        """
+        neighbors: dict: peer_id -> list of neighbor ids (symmetric, as
+        topology.make_topology gives).  From now on also keep, for every
+        peer, how many of its neighbors have each piece.
+        """
+        bpp = self.blocks_per_piece
+        self.neighbors = neighbors
+        self.local_counts = dict()
+        for pid, ns in neighbors.items():
+            counts = array('i', [0] * len(self.counts))
+            for n in ns:
+                for i, b in enumerate(self.rows[n]):
+                    if b >= bpp:
+                        counts[i] += 1
+            self.local_counts[pid] = counts
+        self.views = dict((pid, memoryview(counts).toreadonly())
+                          for pid, counts in self.local_counts.items())
+
+    def __getitem__(self, peer_id):
+        return self.rows[peer_id]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_blocks(self, peer_id, piece_id, blocks):
+        """
+        Credit peer_id with blocks more blocks of piece_id.  Returns True if
+        that finished the piece.
+        """
+        row = self.rows[peer_id]
+        before = row[piece_id]
+        row[piece_id] += blocks
+        if before >= self.blocks_per_piece or row[piece_id] < self.blocks_per_piece:
+            return False
+        self.completed[peer_id] += 1
+        self.counts[piece_id] += 1
+        if self.neighbors is not None:
+            # Neighborhoods are symmetric, so these are the peers that see it
+            for n in self.neighbors[peer_id]:
+                self.local_counts[n][piece_id] += 1
+        if self.completed[peer_id] == len(row):
+            self.num_done += 1
+            self.newly_done.append(peer_id)
+        return True
+
+    @property
+    def piece_counts(self):
+        """Read-only view: piece_counts[i] is how many peers have piece i."""
+        return self.counts_view
+
+    def counts_for(self, peer_id):
+        """
+        Read-only view of the piece counts peer_id gets to see: over its
+        neighbors under a topology, otherwise over the whole swarm.
+        """
+        if self.views is None:
+            return self.counts_view
+        return self.views[peer_id]
+
+    def peer_done(self, peer_id):
+        return self.completed[peer_id] == len(self.rows[peer_id])
+
+    def all_done(self):
+        return self.num_done == len(self.rows)
+
+    def pop_newly_done(self):
+        """Return the peers that finished since the last call, in the order
+        they finished."""
+        done, self.newly_done = self.newly_done, []
+        return done
+
+    def __repr__(self):
+        return "PieceState(%s)" % self.rows
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+"""
+Opt-in profiling for the simulator.
+
+Sim.run_sim_once can call hooks around each phase of a round (see PHASES
+and Sim.add_hook).  The profilers here build on that:
+  - PhaseClock:  wall-clock seconds spent in each phase
+  - Sampler:     low-overhead sampling profiler driven by a SIGPROF timer
+  - CProfiler:   the standard cProfile, saved to a file for pstats
+
+None of this is set up unless asked for, so normal runs don't pay for it.
+"""
+
+import cProfile
+import io
+import pstats
+import signal
+import time
+
+# The parts of a round that hooks get called around.  requests and uploads
+# are the agents' own requests() and uploads() calls, validation is the
+# sim checking what they returned, pieces is update_peer_pieces and history
+# is History.update.
+PHASES = ("requests", "uploads", "validation", "pieces", "history")
+
+
+class PhaseHooks:
+    """Callbacks to run before and after each phase of a round."""
+    def __init__(self):
+        self.before = dict((phase, []) for phase in PHASES)
+        self.after = dict((phase, []) for phase in PHASES)
+
+    def register(self, before=None, after=None, phases=PHASES):
+        """
+        before, after: functions taking the phase name
+        phases: which phases to call them around
+        """
+        for phase in phases:
+            if phase not in self.before:
+                raise ValueError("Unknown phase: %s" % phase)
+            if before is not None:
+                self.before[phase].append(before)
+            if after is not None:
+                self.after[phase].insert(0, after)
+
+    def call(self, phase, f, *args):
+        """Call f(*args) as part of phase, running the hooks around it."""
+        for g in self.before[phase]:
+            g(phase)
+        try:
+            return f(*args)
+        finally:
+            for g in self.after[phase]:
+                g(phase)
+
+
+class PhaseClock:
+    """Adds up the wall-clock time spent in each phase."""
+    def __init__(self):
+        self.times = dict((phase, 0.0) for phase in PHASES)
+        self.started = []
+
+    def install(self, sim):
+        sim.add_hook(before=self.enter, after=self.exit)
+
+    def enter(self, phase):
+        self.started.append(time.perf_counter())
+
+    def exit(self, phase):
+        self.times[phase] += time.perf_counter() - self.started.pop()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def report(self):
+        total = sum(self.times.values()) or 1
+        return "\n".join("%-10s %8.3fs  %3.0f%%" % (
+            phase, self.times[phase], 100 * self.times[phase] / total)
+                         for phase in PHASES)
+
+
+class Sampler:
+    """
+    Sampling profiler.  Every interval seconds of CPU time a SIGPROF handler
+    looks at the running stack and counts the function on top of it (self
+    time) and every function on it (total time), as well as the phase the
+    sim is in.  Cheap enough to leave on for long runs.  Unix only.
+    """
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.self_counts = dict()   # (file, line, function) -> samples
+        self.total_counts = dict()
+        self.phase_counts = dict()  # phase or None -> samples
+        self.samples = 0
+        self.phase = None
+
+    def install(self, sim):
+        sim.add_hook(before=self.enter, after=self.exit)
+
+    def enter(self, phase):
+        self.phase = phase
+
+    def exit(self, phase):
+        self.phase = None
+
+    def sample(self, signum, frame):
+        self.samples += 1
+        self.phase_counts[self.phase] = self.phase_counts.get(self.phase, 0) + 1
+        seen = set()
+        top = True
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if top:
+                self.self_counts[key] = self.self_counts.get(key, 0) + 1
+                top = False
+            if key not in seen:
+                seen.add(key)
+                self.total_counts[key] = self.total_counts.get(key, 0) + 1
+            frame = frame.f_back
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def report(self, limit=20):
+        n = self.samples or 1
+        lines = ["%d samples every %gs" % (self.samples, self.interval),
+                 "By phase:"]
+        for phase in PHASES + (None,):
+            if phase in self.phase_counts:
+                lines.append("  %-10s %5.1f%%" % (
+                    phase or "other", 100.0 * self.phase_counts[phase] / n))
+        lines.append("   self%   total%  function")
+        top = sorted(self.self_counts.items(), key=lambda kv: kv[1], reverse=True)
+        for (key, count) in top[:limit]:
+            lines.append("  %5.1f%%  %5.1f%%  %s (%s:%d)" % (
+                100.0 * count / n, 100.0 * self.total_counts[key] / n,
+                key[2], key[0], key[1]))
+        return "\n".join(lines)
+
+
+class CProfiler:
+    """The standard deterministic profiler.  Saves its stats to filename."""
+    def __init__(self, filename="out.prof"):
+        self.filename = filename
+        self.profile = cProfile.Profile()
+
+    def install(self, sim):
+        pass
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.filename)
+
+    def report(self, limit=20):
+        s = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=s)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return "Saved profile to %s\n%s" % (self.filename, s.getvalue())
+
+
+PROFILERS = {
+    "phases": PhaseClock,
+    "sample": Sampler,
+    "cprofile": CProfiler,
+}
+
+
+def make_profiler(name, filename):
+    """Return a profiler for one of the names in PROFILERS."""
+    if name not in PROFILERS:
+        raise ValueError("Unknown profiler: %s (choose from %s)" % (
+            name, ", ".join(sorted(PROFILERS))))
+    if name == "cprofile":
+        return CProfiler(filename)
+    return PROFILERS[name]()
@@ -6,6 +6,8 @@ from util import even_split
 from peer import Peer
 
 class Seed(Peer):
+    skip_when_idle = True
+
     def requests(self, peers, history):
         # Seeds don't need anything.
         return []
@@ -8,6 +8,7 @@ Simulates one file being shared amongst a set of peers.  The file is divided int
 The simulation proceeds in rounds.  In each round, peers can request pieces from other peers, and then decide how much to upload to others.  Once every peer has every piece, the simulation ends.
 """
 
+import os
 import re
 import random
 import sys
@@ -15,18 +16,46 @@ import logging
 import copy
 import itertools
 import pprint
+import multiprocessing
 from optparse import OptionParser
 
-from messages import Upload, Request, Download, PeerInfo
+from messages import Upload, Request, Download, PeerInfo, PeerView, NeighborView
 from util import *
-from stats import Stats
+from stats import Stats, RunningStats, stddev_str
 from history import History
+from pieces import PieceSet, PieceState
+from profiling import PHASES, PhaseHooks, make_profiler
+from topology import TOPOLOGIES, check_topology, make_topology
+from batch import Batch
+from drivers import DRIVERS, THREAD_WORKERS, make_driver
     
 
+# What check_uploads and check_requests complain about, by rule number.
+UPLOAD_ERRORS = (
+    "List of Uploads contains non-Upload object.",
+    "Can't upload to yourself.",
+    "Upload.from != peer id.",
+    "Upload bandwidth must be non-negative!",
+)
+
+REQUEST_ERRORS = (
+    "List of Requests contains non-Request object.",
+    "Request asks for non-existent piece!",
+    "Request mentions non-existent peer!",
+    "Request has wrong peer id!",
+    "Request has bad start block!",
+    "Asking for piece peer does not have!",
+    "Request mentions peer that isn't a neighbor!",
+)
+
+
 class Sim:
     def __init__(self, config):
         self.config = config
         self.up_bws_state = dict()
+        # PhaseHooks to call around each phase of a round, or None if there
+        # aren't any.  See add_hook.
+        self.hooks = None
 
     
     def up_bw(self, peer_id, reinit=False):
@@ -39,104 +68,126 @@ class Sim:
             del s[peer_id]
         
         """Sets the upload bandwidth of seeds to max, other agents at random"""
+        # Only draw a new one when needed, so that how often the sim asks
+        # (e.g. whether uploads get validated) doesn't change the random
+        # stream the agents see.
+        if peer_id in s:
+            return s[peer_id]
         if re.match("Seed",peer_id): the_up_bw = c.max_up_bw
         else: the_up_bw = random.randint(c.min_up_bw, c.max_up_bw)
         
         return s.setdefault(peer_id, the_up_bw)
 
+    def add_hook(self, before=None, after=None, phases=PHASES):
+        """
+        Have run_sim_once call before(phase) and after(phase) around each of
+        the given phases of every round (see profiling.PHASES).
+        """
+        if self.hooks is None:
+            self.hooks = PhaseHooks()
+        self.hooks.register(before, after, phases)
+
     def run_sim_once(self):
         """Return a history"""
         conf = self.config
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0  
 
-        def check_pred(pred, msg, Exc, lst):
-            """Check if any element of lst matches the predicate.  If it does,
-            raise an exception of type Exc, including the msg and the offending
-            element."""
-            m = list(map(pred, lst))
-            if True in m:
-                i = m.index(True)
-                raise Exc(msg + " Bad element: %s" % lst[i])
+        # Only go through the hooks if someone registered some
+        hooks = self.hooks
 
-        def check_uploads(peer, uploads):
-            """Raise an IllegalUpload exception if there is a problem."""
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalUpload, uploads)
+        def raise_problem(Exc, messages, problem, lst):
+            """problem is the (rule number, index) of the first problem found,
+            or None.  If there was one, raise an exception of type Exc,
+            including the rule's message and the offending element."""
+            if problem is not None:
+                (rule, i) = problem
+                raise Exc(messages[rule] + " Bad element: %s" % lst[i])
 
-            not_upload = lambda o: not isinstance(o, Upload)
-            check(not_upload, "List of Uploads contains non-Upload object.")
+        # Each list is checked in a single pass.  For every element we find
+        # the first rule it breaks, and report the lowest-numbered rule that
+        # any element breaks (first such element).  That's the same error
+        # checking each rule over the whole list in turn would give.
 
-            self_upload = lambda upload: upload.to_id == peer.id
-            check(self_upload, "Can't upload to yourself.")
-            
-            not_from_self = lambda upload: upload.from_id != peer.id
-            check(not_from_self, "Upload.from != peer id.")
-
-            check(lambda u: u.bw < 0, "Upload bandwidth must be non-negative!")
-
-            limit = self.up_bw(peer.id)
-            if sum([u.bw for u in uploads]) > limit:
+        def check_uploads(peer, uploads):
+            """Raise an IllegalUpload exception if there is a problem."""
+            problem = None
+            total = 0
+            for i, u in enumerate(uploads):
+                if not isinstance(u, Upload):
+                    rule = 0
+                elif u.to_id == peer.id:
+                    rule = 1
+                elif u.from_id != peer.id:
+                    rule = 2
+                elif u.bw < 0:
+                    rule = 3
+                else:
+                    total += u.bw
+                    continue
+                if problem is None or rule < problem[0]:
+                    problem = (rule, i)
+                    if rule == 0:
+                        break
+            raise_problem(IllegalUpload, UPLOAD_ERRORS, problem, uploads)
+
+            # The rate fixed when the run started: checking mustn't touch
+            # the random stream, or how often we check would change results
+            limit = upload_rates[peer.id]
+            if total > limit:
                 raise IllegalUpload("Can't upload more than limit of %d. Attempted to upload %s, for uploads: %s" % (
-                    limit, sum([u.bw for u in uploads])), uploads)
+                    limit, total, uploads))
 
             # If we got here, looks ok.
 
         def check_requests(peer, requests, peer_pieces, available):
             """Raise an IllegalRequest exception if there is a problem."""
+            num_pieces = conf.num_pieces
+            blocks_per_piece = conf.blocks_per_piece
+            my_pieces = peer_pieces[peer.id]
+            peer_ids = self.peer_id_set
+            my_neighbors = None if neighbors is None else neighbor_sets[peer.id]
+            problem = None
+            for i, r in enumerate(requests):
+                if not isinstance(r, Request):
+                    rule = 0
+                elif r.piece_id < 0 or r.piece_id >= num_pieces:
+                    rule = 1
+                elif r.peer_id not in peer_ids:
+                    rule = 2
+                elif r.requester_id != peer.id:
+                    rule = 3
+                elif (r.start < 0 or
+                      r.start >= blocks_per_piece or
+                      r.start > my_pieces[r.piece_id]):
+                    # Must request the _next_ necessary block
+                    rule = 4
+                elif r.piece_id not in available[r.peer_id]:
+                    rule = 5
+                elif my_neighbors is not None and r.peer_id not in my_neighbors:
+                    rule = 6
+                else:
+                    continue
+                if problem is None or rule < problem[0]:
+                    problem = (rule, i)
+                    if rule == 0:
+                        break
+            raise_problem(IllegalRequest, REQUEST_ERRORS, problem, requests)
 
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalRequest, requests)
-
-            check(lambda o: not isinstance(o, Request),
-                  "List of Requests contains non-Request object.")
-
-            bad_piece_id = lambda r: (r.piece_id < 0 or
-                                      r.piece_id >= self.config.num_pieces)
-            check(bad_piece_id, "Request asks for non-existent piece!")
-            
-            bad_peer_id = lambda r: r.peer_id not in self.peer_ids
-            check(bad_peer_id, "Request mentions non-existent peer!")
-
-            bad_requester_id = lambda r: r.requester_id != peer.id
-            check(bad_requester_id, "Request has wrong peer id!")
-
-            bad_start_block = lambda r: (
-                r.start < 0 or
-                r.start >= self.config.blocks_per_piece or
-                r.start > peer_pieces[peer.id][r.piece_id])
-            # Must request the _next_ necessary block
-            check(bad_start_block, "Request has bad start block!")
-
-            def piece_peer_does_not_have(r):
-                other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
-            check(piece_peer_does_not_have, "Asking for piece peer does not have!")
-            
             # If we got here, looks ok
 
         def available_pieces(peer_id, peer_pieces):
             """
-            Return a list of piece ids that this peer has available.
+            Return a PieceSet of the piece ids that this peer has available.
             """
-            return [i for i in range(conf.num_pieces) if peer_pieces[peer_id][i] == conf.blocks_per_piece]
-
-        def peer_done(peer_pieces, peer_id):
-            # TODO: remove linear pass
-            for blocks_so_far in peer_pieces[peer_id]:
-                if blocks_so_far < conf.blocks_per_piece:
-                    return False
-            return True
-            
+            return PieceSet(i for i in range(conf.num_pieces) if peer_pieces[peer_id][i] == conf.blocks_per_piece)
+
         def all_done(peer_pieces):
-            result = True
-            # Check all peers to update done status
-            for peer_id in peer_pieces:
-                if peer_done(peer_pieces, peer_id):
-                    history.peer_is_done(round, peer_id)
-                else:
-                    result = False
-            return result
+            # Only the peers that finished this round need their done
+            # status recorded.
+            for peer_id in peer_pieces.pop_newly_done():
+                history.peer_is_done(round, peer_id)
+            return peer_pieces.all_done()
 
         def create_peers():
             """Each agent class must be already loaded, and have a
@@ -169,7 +220,8 @@ class Sim:
                     return [0]*conf.num_pieces
                 
             peer_pieces = dict()  # id -> list (blocks / piece)
-            peer_pieces = dict((id, get_pieces(id)) for id in ids)
+            peer_pieces = PieceState(dict((id, get_pieces(id)) for id in ids),
+                                     conf.blocks_per_piece)
             pieces = [get_pieces(id) for id in ids]
             r = itertools.repeat
             
@@ -182,36 +234,141 @@ class Sim:
             #logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
             return peers, peer_pieces
 
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return [peer for peer in peer_info if peer.id != p.id]
-
+        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available,
+                              validate):
+            others = peer_view(p, peer_info)
             pieces = copy.copy(peer_pieces[p.id])
             # Made copy of pieces and the peer info this peer needs to make it's
             # decision, so that it can't change the simulation's copies.
             p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
+            if hooks is None:
+                rs = p.requests(others, peer_history)
+            else:
+                rs = hooks.call("requests", p.requests, others, peer_history)
+            if validate:
+                validate_requests(p, rs, peer_pieces, available)
             return rs
 
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return [peer for peer in peer_info if peer.id != p.id]
+        def validate_requests(p, rs, peer_pieces, available):
+            if hooks is None:
+                check_requests(p, rs, peer_pieces, available)
+            else:
+                hooks.call("validation", check_requests, p, rs, peer_pieces,
+                           available)
+
+        def get_peer_uploads(requests, p, peer_info, peer_history, validate):
+            others = peer_view(p, peer_info)
+            if hooks is None:
+                us = p.uploads(requests, others, peer_history)
+            else:
+                us = hooks.call("uploads", p.uploads, requests, others,
+                                peer_history)
+            if validate:
+                validate_uploads(p, us)
+            return us
 
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in list(all_requests.values()):
-                    ans.extend(list(filter(f, rs)))
-                return ans
+        def validate_uploads(p, us):
+            if hooks is None:
+                check_uploads(p, us)
+            else:
+                hooks.call("validation", check_uploads, p, us)
+
+        def get_batch_requests(cls, agents, peer_info, h, peer_pieces, available,
+                               unchecked_ids):
+            """Requests for all the agents of class cls at once, through
+            cls.requests_batch.  Returns a list of lists, like agents."""
+            for p in agents:
+                p.update_pieces(copy.copy(peer_pieces[p.id]))
+            batch = Batch(agents, [peer_view(p, peer_info) for p in agents],
+                          [h[p.id] for p in agents], round,
+                          peer_pieces.piece_counts, peer_info, conf.num_pieces)
+            if hooks is None:
+                rss = cls.requests_batch(batch)
+            else:
+                rss = hooks.call("requests", cls.requests_batch, batch)
+            for (p, rs) in zip(agents, rss):
+                if p.id not in unchecked_ids:
+                    validate_requests(p, rs, peer_pieces, available)
+            return rss
+
+        def get_batch_uploads(cls, agents, requests_to, peer_info, h,
+                              unchecked_ids):
+            """Uploads for all the agents of class cls at once, through
+            cls.uploads_batch.  Returns a list of lists, like agents."""
+            batch = Batch(agents, [peer_view(p, peer_info) for p in agents],
+                          [h[p.id] for p in agents], round,
+                          peer_pieces.piece_counts, peer_info, conf.num_pieces,
+                          [requests_to[p.id] for p in agents])
+            if hooks is None:
+                uss = cls.uploads_batch(batch)
+            else:
+                uss = hooks.call("uploads", cls.uploads_batch, batch)
+            for (p, us) in zip(agents, uss):
+                if p.id not in unchecked_ids:
+                    validate_uploads(p, us)
+            return uss
+
+        def get_driven_requests(agents, peer_info, h, peer_pieces, available,
+                                unchecked_ids):
+            """Requests for the agents, through the driver"""
+            views = [peer_view(p, peer_info) for p in agents]
+            hs = [h[p.id] for p in agents]
+            pieces = [copy.copy(peer_pieces[p.id]) for p in agents]
+            if hooks is None:
+                rss = driver.requests(agents, views, hs, pieces)
+            else:
+                rss = hooks.call("requests", driver.requests, agents, views, hs,
+                                 pieces)
+            for (p, rs) in zip(agents, rss):
+                if p.id not in unchecked_ids:
+                    validate_requests(p, rs, peer_pieces, available)
+            return rss
+
+        def get_driven_uploads(agents, requests_to, peer_info, h, unchecked_ids):
+            """Uploads for the agents, through the driver"""
+            views = [peer_view(p, peer_info) for p in agents]
+            hs = [h[p.id] for p in agents]
+            rss = [requests_to[p.id] for p in agents]
+            if hooks is None:
+                uss = driver.uploads(agents, rss, views, hs)
+            else:
+                uss = hooks.call("uploads", driver.uploads, agents, rss, views, hs)
+            for (p, us) in zip(agents, uss):
+                if p.id not in unchecked_ids:
+                    validate_uploads(p, us)
+            return uss
+
+        def batches(peers, method):
+            """
+            Split peers into (dict: class -> its peers, for the classes
+            that have the batch version of method) and a list of the rest.
+            """
+            batched = dict()
+            solo = []
+            for p in peers:
+                cls = p.__class__
+                if conf.batch and getattr(cls, method) is not None:
+                    batched.setdefault(cls, []).append(p)
+                else:
+                    solo.append(p)
+            return batched, solo
 
-            requests = requests_to(p.id)
+        def peer_view(p, peer_info):
+            """What p gets to see of the other peers"""
+            if neighbors is None:
+                return PeerView(peer_info, peer_index[p.id])
+            return NeighborView(peer_info, neighbor_index[p.id])
 
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
-            check_uploads(p, us)
-            return us
+        def index_requests(requests):
+            """
+            Return dict: peer_id -> list of the Requests made _to_ that peer,
+            in the order the requesters made them.
+            """
+            requests_to = dict((pid, []) for pid in self.peer_ids)
+            for rs in requests.values():
+                for r in rs:
+                    requests_to[r.peer_id].append(r)
+            return requests_to
 
         def upload_rate(uploads, uploader_id, requester_id):
             """
@@ -229,10 +386,13 @@ class Sim:
             pieces the requesters ended up with.
             Make sure requesting the same thing from lots of peers doesn't
             stack.
-            update the sets of available pieces as needed.
+            update the sets of available pieces as needed.  (PieceSets are
+            immutable, so this replaces the peer's entry in available.)
+
+            peer_pieces is updated in place -- only the rows of peers that
+            downloaded something change.
             """
             downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
             for requester_id in requests:
                 downloads[requester_id] = list()
             for requester_id in requests:
@@ -264,131 +424,345 @@ class Sim:
                             break
                 for piece_id in new_blocks_per_piece:
                     (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
+                    if peer_pieces.add_blocks(requester_id, piece_id, blocks):
+                        available[requester_id] = \
+                            available[requester_id].with_piece(piece_id)
                     d = Download(peer_id, requester_id, piece_id, blocks)
                     downloads[requester_id].append(d)
                 
-            return (new_pp, downloads)
+            return (peer_pieces, downloads)
 
         def completed_pieces(peer_id, available):
             return len(available[peer_id])
         
         def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
-                            for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
+            if debug:
+                for p_id in self.peer_ids:
+                    pieces = peer_pieces[p_id]
+                    logging.debug("pieces for %s: %s", p_id, pieces)
+            if info:
+                log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
+                                for p_id in self.peer_ids)
+                logging.info("Pieces completed: " + log)
 
 
-        logging.debug("Starting simulation with config: %s" % str(conf))
+        # Decide once per run whether to build the log messages at all, so
+        # that quiet runs don't pay for formatting them.
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        info = logging.getLogger().isEnabledFor(logging.INFO)
+
+        logging.debug("Starting simulation with config: %s", conf)
 
         peers, peer_pieces = create_peers()
         self.peer_ids = [p.id for p in peers]
+        self.peer_id_set = set(self.peer_ids)
         self.peers_by_id = dict((p.id, p) for p in peers)
         
         upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
+        history = History(self.peer_ids, upload_rates,
+                          conf.history_window, conf.history_dir)
 
-        # dict : pid -> set(finished / available pieces)
-        available = dict((pid, set(available_pieces(pid, peer_pieces)))
+        # dict : pid -> PieceSet(finished / available pieces)
+        available = dict((pid, available_pieces(pid, peer_pieces))
                          for pid in self.peer_ids)
 
-        # Begin the event loop
-        while True:
-            logging.info("======= Round %d ========" % round)
-
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
-            uploads = dict()   # peer_id -> list of Uploads
-            h = dict()
-            for p in peers:
-                h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
+        # Peers of trusted classes never get their requests and uploads
+        # validated.  Everyone else gets validated every validate_every
+        # rounds.
+        trusted_ids = set(p.id for p in peers
+                          if p.trusted or
+                          p.__class__.__name__ in conf.trusted_classes)
+
+        # What the agents see of each other: a tuple of read-only PeerInfos,
+        # shared by everyone and only rebuilt when someone's pieces change.
+        # Each agent gets a PeerView of it that leaves itself out.
+        peer_index = dict((p.id, i) for i, p in enumerate(peers))
+        peer_info = tuple(PeerInfo(p.id, available[p.id]) for p in peers)
+
+        # Classes with requests_batch / uploads_batch get called once per
+        # round for all their peers; everyone else one at a time.
+        (request_batches, solo_requesters) = batches(peers, "requests_batch")
+        (upload_batches, solo_uploaders) = batches(peers, "uploads_batch")
+        # If so, once nobody requests anything the rest of the run is idle
+        all_skip_when_idle = all(p.skip_when_idle for p in peers)
+
+        # peer_id -> list of neighbor ids, or None if everyone sees everyone.
+        # Agents only see their neighbors, and may only request from them.
+        neighbors = make_topology(conf, self.peer_ids)
+        if neighbors is not None:
+            neighbor_index = dict(
+                (pid, tuple(peer_index[n] for n in ns))
+                for pid, ns in neighbors.items())
+            neighbor_sets = dict((pid, set(ns)) for pid, ns in neighbors.items())
+            # ... and only count pieces among their neighbors
+            peer_pieces.count_neighbors(neighbors)
+
+        # Agents that aren't called in batches go through a driver if asked
+        # for (see drivers.py), otherwise they're just called in turn.
+        driver = None
+        if conf.driver != "serial" or conf.deadline is not None:
+            solo_ids = set(p.id for p in solo_requesters + solo_uploaders)
+            driver = make_driver(conf, [p for p in peers if p.id in solo_ids],
+                                 self.peer_ids, upload_rates, peer_index,
+                                 neighbor_index if neighbors is not None else None)
 
-            for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
+        # Begin the event loop
+        try:
+            while True:
+                logging.info("======= Round %d ========", round)
+
+                if any(info.available_pieces is not available[info.id]
+                       for info in peer_info):
+                    peer_info = tuple(
+                        info if info.available_pieces is available[info.id]
+                        else PeerInfo(info.id, available[info.id])
+                        for info in peer_info)
+                requests = dict()  # peer_id -> list of Requests
+                uploads = dict()   # peer_id -> list of Uploads
+                h = dict()
+
+                if round % conf.validate_every == 0:
+                    unchecked_ids = trusted_ids
+                else:
+                    unchecked_ids = self.peer_id_set
+                for pid in unchecked_ids:
+                    history.unchecked[pid] += 1
+
+                for p in peers:
+                    h[p.id] = history.peer_history(p.id, peer_pieces.counts_for(p.id))
+
+                # In event-driven mode, idle peers that are fine with it don't
+                # get called: they'd have nothing to say.
+                if conf.event_driven:
+                    wants = lambda p: not (p.skip_when_idle and
+                                           peer_pieces.peer_done(p.id))
+                else:
+                    wants = lambda p: True
+
+                for (cls, agents) in request_batches.items():
+                    agents = [p for p in agents if wants(p)]
+                    if agents:
+                        rss = get_batch_requests(cls, agents, peer_info, h, peer_pieces,
+                                                 available, unchecked_ids)
+                        requests.update(zip([p.id for p in agents], rss))
+                if driver is None:
+                    for p in solo_requesters:
+                        if wants(p):
+                            requests[p.id] = get_peer_requests(p, peer_info, h[p.id],
+                                                               peer_pieces, available,
+                                                               p.id not in unchecked_ids)
+                else:
+                    driver.start_round(peer_info)
+                    agents = [p for p in solo_requesters if wants(p)]
+                    rss = get_driven_requests(agents, peer_info, h, peer_pieces,
+                                              available, unchecked_ids)
+                    requests.update(zip([p.id for p in agents], rss))
+                if request_batches or conf.event_driven:
+                    # back in peer order, with the skipped peers asking for nothing
+                    requests = dict((p.id, requests.get(p.id, [])) for p in peers)
+
+                requests_to = index_requests(requests)
+                if conf.event_driven:
+                    wants = lambda p: not (p.skip_when_idle and not requests_to[p.id])
+
+                for (cls, agents) in upload_batches.items():
+                    agents = [p for p in agents if wants(p)]
+                    if agents:
+                        uss = get_batch_uploads(cls, agents, requests_to, peer_info, h,
+                                                unchecked_ids)
+                        uploads.update(zip([p.id for p in agents], uss))
+                if driver is None:
+                    for p in solo_uploaders:
+                        if wants(p):
+                            uploads[p.id] = get_peer_uploads(requests_to[p.id], p,
+                                                             peer_info, h[p.id],
+                                                             p.id not in unchecked_ids)
+                else:
+                    agents = [p for p in solo_uploaders if wants(p)]
+                    uss = get_driven_uploads(agents, requests_to, peer_info, h,
+                                             unchecked_ids)
+                    uploads.update(zip([p.id for p in agents], uss))
+                if upload_batches or conf.event_driven:
+                    uploads = dict((p.id, uploads.get(p.id, [])) for p in peers)
                 
 
-            (peer_pieces, downloads) = update_peer_pieces(
-                peer_pieces, requests, uploads, available)
-            history.update(downloads, uploads)
+                if hooks is None:
+                    (peer_pieces, downloads) = update_peer_pieces(
+                        peer_pieces, requests, uploads, available)
+                    history.update(downloads, uploads)
+                else:
+                    (peer_pieces, downloads) = hooks.call("pieces", update_peer_pieces,
+                        peer_pieces, requests, uploads, available)
+                    hooks.call("history", history.update, downloads, uploads)
+                if driver is not None:
+                    driver.end_round(downloads, uploads)
 
-            logging.debug(history.pretty_for_round(round))
+                if debug:
+                    logging.debug(history.pretty_for_round(round))
 
-            log_peer_info(peer_pieces, available)
+                log_peer_info(peer_pieces, available)
            
-            if all_done(peer_pieces):
-                logging.info("All done!")                    
-                break
-            round += 1
-            if round > conf.max_round:
-                logging.info("Out of time.  Stopping.")
-                break
-
-        logging.info("Game history:\n%s" % history.pretty())
-
-        logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
+                if all_done(peer_pieces):
+                    logging.info("All done!")                    
+                    break
+
+                if (conf.event_driven and all_skip_when_idle and
+                        not any(requests.values()) and
+                        (driver is None or driver.round_overruns == 0)):
+                    # Nobody asked for anything, so nothing changed, and every
+                    # agent will do the same next round: we're stuck.  Skip
+                    # straight to the end.  (Unless someone only said nothing
+                    # because they ran out of time.)
+                    if round < conf.max_round:
+                        logging.info("Nothing left to do; skipping rounds %d-%d",
+                                     round + 1, conf.max_round)
+                        history.add_idle_rounds(conf.max_round - round)
+                        round = conf.max_round
+
+                round += 1
+                if round > conf.max_round:
+                    logging.info("Out of time.  Stopping.")
+                    break
+        except BaseException:
+            # The caller never gets the history, so clean up its spill file
+            history.close()
+            raise
+        finally:
+            # Don't leave worker processes or threads behind, even on errors
+            if driver is not None:
+                driver.close()
+
+        if driver is not None:
+            history.latency = driver.latency
+
+        if info:
+            logging.info("Game history:\n%s", history.pretty())
+
+            logging.info("======== STATS ========")
+            logging.info("Uploaded blocks:\n%s",
+                         Stats.uploaded_blocks_str(self.peer_ids, history))
+            logging.info("Completion rounds:\n%s",
+                         Stats.completion_rounds_str(self.peer_ids, history))
+            logging.info("All done round: %s",
+                         Stats.all_done_round(self.peer_ids, history))
+            if trusted_ids or conf.validate_every > 1:
+                logging.info("Unchecked rounds:\n%s",
+                             Stats.unchecked_rounds_str(self.peer_ids, history))
+            if history.latency:
+                logging.info("Agent latency:\n%s",
+                             Stats.latency_str(self.peer_ids, history))
 
         return history
 
-    def run_sim(self):
-        histories = [self.run_sim_once() for i in range(self.config.iters)]
-        logging.warning("======== SUMMARY STATS ========")
-        
-        uploaded_blocks = [Stats.uploaded_blocks(self.peer_ids, h) for h in histories]
-        completion_rounds = [Stats.completion_rounds(self.peer_ids, h) for h in histories]
+    def iteration_seeds(self):
+        """Return one random seed per iteration, or Nones if the run isn't
+        seeded.  Parallel runs are always seeded so that each worker gets its
+        own reproducible stream."""
+        conf = self.config
+        base = conf.seed
+        if base is None and conf.workers > 1:
+            base = random.randrange(2**32)
+            logging.warning("Using seed %d" % base)
+        if base is None:
+            return [None] * conf.iters
+        return [base + i for i in range(conf.iters)]
+
+    def run_iterations(self):
+        """Run config.iters simulations, fanning them out across
+        config.workers processes if asked to.  Yields the histories in
+        iteration order, as they finish."""
+        conf = self.config
+        seeds = self.iteration_seeds()
+        if conf.workers <= 1:
+            for seed in seeds:
+                if seed is not None:
+                    random.seed(seed)
+                yield self.run_sim_once()
+            return
+
+        # The agent classes get re-imported by each worker, so leave them
+        # out of the config we ship over.
+        worker_conf = copy.copy(conf)
+        del worker_conf.agent_classes
+        pool = multiprocessing.Pool(conf.workers)
+        try:
+            for history in pool.imap(run_sim_worker,
+                                     [(worker_conf, seed) for seed in seeds],
+                                     chunksize=1):
+                self.peer_ids = history.peer_ids
+                yield history
+        finally:
+            pool.close()
+            pool.join()
 
-        def extract_by_peer_id(lst, peer_id):
-            """Given a list of dicts, pull out the entry
-            for peer_id from each dict.  Return a list"""
-            return [d[peer_id] for d in lst]
+    def run_sim(self):
+        conf = self.config
+        # Each iteration's stats get folded in as it finishes, and its
+        # history dropped, so memory doesn't grow with the number of
+        # iterations.
+        uploaded = None
+        completion = None
+        unchecked = 0
+        total = 0
+        calls = 0
+        overruns = 0
+        for i, h in enumerate(self.run_iterations()):
+            if uploaded is None:
+                uploaded = RunningStats(self.peer_ids)
+                completion = RunningStats(self.peer_ids)
+            uploaded.add(Stats.uploaded_blocks(self.peer_ids, h))
+            completion.add(Stats.completion_rounds(self.peer_ids, h))
+            unchecked += sum(h.unchecked.values())
+            total += len(h.peer_ids) * (h.last_round() + 1)
+            for (n, seconds, slowest, over) in h.latency.values():
+                calls += n
+                overruns += over
+
+            if conf.save_history is not None:
+                filename = conf.save_history
+                if conf.iters > 1:
+                    filename = "%s.%d" % (filename, i)
+                h.save(filename)
+                logging.warning("Saved history to %s" % filename)
+            h.close()
 
-        uploaded_by_id = dict(
-            (p_id, extract_by_peer_id(uploaded_blocks, p_id))
-            for p_id in self.peer_ids)
+        logging.warning("======== SUMMARY STATS ========")
 
-        completion_by_id = dict(
-            (p_id, extract_by_peer_id(completion_rounds, p_id))
-            for p_id in self.peer_ids)
+        # peer_id -> (mean, stddev) over the iterations
+        uploaded_by_id = uploaded.result()
+        completion_by_id = completion.result()
 
         logging.warning("Uploaded blocks: avg (stddev)")
         for p_id in sorted(self.peer_ids,
-                           key=lambda id: mean(uploaded_by_id[id])):
-            us = uploaded_by_id[p_id]
-            logging.warning("%s: %.1f  (%.1f)" % (p_id, mean(us), stddev(us)))
+                           key=lambda id: uploaded_by_id[id][0]):
+            (m, sd) = uploaded_by_id[p_id]
+            logging.warning("%s: %.1f  (%.1f)" % (p_id, m, sd))
 
         logging.warning("Completion rounds: avg (stddev)")
 
-        def optionize(f):
-            def g(lst):
-                if None in lst:
-                    return None
-                else:
-                    return f(lst)
-            return g
-
-        opt_mean = optionize(mean)
-        opt_stddev = optionize(stddev)
-        
         for p_id in sorted(self.peer_ids,
-                           key=lambda id: opt_mean(completion_by_id[id]) or 0):
-            cs = completion_by_id[p_id]
-            logging.warning("%s: %s  (%s)" % (p_id, opt_mean(cs), opt_stddev(cs)))
+                           key=lambda id: completion_by_id[id][0] or 0):
+            (m, sd) = completion_by_id[p_id]
+            logging.warning("%s: %s  (%s)" % (p_id, m, stddev_str(sd)))
+
+        if unchecked > 0:
+            logging.warning("Validation skipped for %d of %d agent-rounds" % (
+                unchecked, total))
+        if overruns > 0:
+            logging.warning("Agent calls over the deadline: %d of %d" % (
+                overruns, calls))
 
 
 
+def run_sim_worker(args):
+    """Run a single seeded iteration in a worker process and return its
+    history.  args is a (config, seed) pair."""
+    config, seed = args
+    config.add("agent_classes", load_modules(config.agent_class_names))
+    random.seed(seed)
+    return Sim(config).run_sim_once()
+
+
 def configure_logging(loglevel):
     numeric_level = getattr(logging, loglevel.upper(), None)
     if not isinstance(numeric_level, int):
@@ -460,6 +834,83 @@ def main(args):
                       dest="iters", default=1, type="int",
                       help="Number of times to run simulation to get stats")
 
+    parser.add_option("--workers",
+                      dest="workers", default=1, type="int",
+                      help="Number of processes to spread the iterations over")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Random seed; iteration i uses seed+i")
+
+    parser.add_option("--topology",
+                      dest="topology", default="full",
+                      help="Who sees whom: %s" % ", ".join(TOPOLOGIES))
+
+    parser.add_option("--degree",
+                      dest="degree", default=10, type="int",
+                      help="Neighbors per peer for the kregular and tracker topologies")
+
+    parser.add_option("--edges",
+                      dest="edge_file", default=None,
+                      help="Edge list file for the file topology")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=None, type="int",
+                      help="Keep only this many rounds of history in memory "
+                      "and spill older ones to disk (agents looking further "
+                      "back still work, just slower)")
+
+    parser.add_option("--history-dir",
+                      dest="history_dir", default=None,
+                      help="Where to put history spill files (default: temp dir)")
+
+    parser.add_option("--save-history",
+                      dest="save_history", default=None,
+                      help="Save each iteration's history to this file "
+                      "(FILE.0, FILE.1, ... if there's more than one) for "
+                      "analyze.py")
+
+    parser.add_option("--no-batch",
+                      dest="batch", default=True, action="store_false",
+                      help="Call every agent's requests() and uploads() one "
+                      "at a time, even for classes with batch versions")
+
+    parser.add_option("--event-driven",
+                      dest="event_driven", default=False, action="store_true",
+                      help="Don't call agents that have nothing to do (for "
+                      "classes with skip_when_idle), and skip to the end once "
+                      "nothing more can happen")
+
+    parser.add_option("--driver",
+                      dest="driver", default="serial",
+                      help="How to call the agents: %s" % ", ".join(DRIVERS))
+
+    parser.add_option("--driver-workers",
+                      dest="driver_workers", default=None, type="int",
+                      help="Worker processes for the process driver (default: "
+                      "number of CPUs), or threads for the thread driver "
+                      "(default: %d)" % THREAD_WORKERS)
+
+    parser.add_option("--deadline",
+                      dest="deadline", default=None, type="float",
+                      help="Seconds an agent gets for each requests() or "
+                      "uploads() call; slower calls count as returning nothing")
+
+    parser.add_option("--trusted",
+                      dest="trusted", default="",
+                      help="Comma-separated agent classes whose requests and uploads aren't validated")
+
+    parser.add_option("--validate-every",
+                      dest="validate_every", default=1, type="int",
+                      help="Only validate requests and uploads every N rounds")
+
+    parser.add_option("--profile",
+                      dest="profile", default=None,
+                      help="Profile the run: 'phases' (time per round phase), 'sample' (sampling profiler) or 'cprofile'")
+
+    parser.add_option("--profile-out",
+                      dest="profile_out", default="out.prof",
+                      help="Where --profile cprofile saves its stats")
 
     (options, args) = parser.parse_args()
 
@@ -475,6 +926,21 @@ def main(args):
         except ValueError as e:
             usage(e)
     
+    if options.driver not in DRIVERS:
+        usage("Unknown driver: %s (choose from %s)" % (
+            options.driver, ", ".join(DRIVERS)))
+    if options.driver == "process" and options.workers > 1:
+        # The --workers processes can't have worker processes of their own
+        usage("--driver process can't be used with --workers")
+
+    if options.history_window is not None and options.history_window < 0:
+        usage("--history-window can't be negative: %d" % options.history_window)
+
+    try:
+        check_topology(options, len(agents_to_run))
+    except ValueError as e:
+        usage(e)
+
     configure_logging(options.loglevel)
     config = Params()
 
@@ -488,13 +954,48 @@ def main(args):
     config.add("min_up_bw", options.min_up_bw)
     config.add("max_up_bw", options.max_up_bw)
     config.add("iters", options.iters)
+    config.add("workers", options.workers)
+    config.add("seed", options.seed)
+    config.add("topology", options.topology)
+    config.add("degree", options.degree)
+    config.add("edge_file", options.edge_file)
+    config.add("history_window", options.history_window)
+    config.add("history_dir", options.history_dir)
+    config.add("save_history", options.save_history)
+    config.add("batch", options.batch)
+    config.add("event_driven", options.event_driven)
+    config.add("driver", options.driver)
+    driver_workers = options.driver_workers
+    if driver_workers is None:
+        if options.driver == "thread":
+            driver_workers = THREAD_WORKERS
+        else:
+            driver_workers = os.cpu_count() or 1
+    config.add("driver_workers", max(1, driver_workers))
+    config.add("deadline", options.deadline)
+    config.add("trusted_classes",
+               [c for c in options.trusted.split(",") if c])
+    config.add("validate_every", max(1, options.validate_every))
     
     sim = Sim(config)
-    sim.run_sim()
 
-if __name__ == "__main__":
+    profiler = None
+    if options.profile is not None:
+        try:
+            profiler = make_profiler(options.profile, options.profile_out)
+        except ValueError as e:
+            usage(e)
+        if options.workers > 1:
+            logging.warning("Only the main process gets profiled with --workers")
+        profiler.install(sim)
+        profiler.start()
+
+    try:
+        sim.run_sim()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            logging.warning("======== PROFILE ========\n%s", profiler.report())
 
-    # The next two lines are for profiling...
-    import cProfile
-    cProfile.run('main(sys.argv)', 'out.prof')
-#    main(sys.argv)
+if __name__ == "__main__":
+    main(sys.argv)
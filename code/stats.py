@@ -1,5 +1,28 @@
 #!/usr/bin/python
 
+import math
+
+# numpy is optional: with it, aggregate() uses whole-array ops, without it
+# it falls back to plain loops.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from util import mean, stddev, median
+
+
+def _number(x):
+    """Totals come back as floats; give back ints where that's what they are."""
+    return int(x) if float(x).is_integer() else float(x)
+
+
+def stddev_str(sd):
+    """A stddev for the summary table, or None.  Fixed precision, so float
+    noise in the last digits doesn't show."""
+    return "None" if sd is None else "%.1f" % sd
+
+
 class Stats:
     @staticmethod
     def uploaded_blocks(peer_ids, history):
@@ -10,13 +33,9 @@ class Stats:
         Returns:
         dict: peer_id -> total upload blocks used
         """
-        uploaded = dict((peer_id, 0) for peer_id in peer_ids)
-        for peer_id in peer_ids:
-            for ds in history.downloads[peer_id]:
-                for download in ds:
-                    uploaded[download.from_id] += download.blocks
-                
-        return uploaded
+        # History.update keeps the totals as it goes
+        return dict((peer_id, _number(history.uploaded[peer_id]))
+                    for peer_id in peer_ids)
 
     @staticmethod
     def uploaded_blocks_str(peer_ids, history):
@@ -49,8 +68,111 @@ class Stats:
 
     @staticmethod
     def all_done_round(peer_ids, history):
-        d = Stats.completion_rounds(peer_ids, history)
-        if None in list(d.values()):
-            return None
-        return max(d.values())
-    
+        for id in peer_ids:
+            if id not in history.round_done:
+                return None
+        return history.last_done
+
+    @staticmethod
+    def unchecked_rounds_str(peer_ids, history):
+        """ Return a pretty stringified version of history.unchecked """
+        rounds = history.last_round() + 1
+        return "\n".join("%s: %d of %d" % (id, history.unchecked[id], rounds)
+                         for id in peer_ids)
+
+    @staticmethod
+    def latency_str(peer_ids, history):
+        """ Return a pretty stringified version of history.latency """
+        lines = []
+        for id in peer_ids:
+            if id in history.latency:
+                (calls, seconds, slowest, overruns) = history.latency[id]
+                lines.append("%s: %d calls, avg %.4fs, max %.4fs, %d over deadline" % (
+                    id, calls, seconds / calls if calls else 0, slowest, overruns))
+        return "\n".join(lines)
+
+    @staticmethod
+    def aggregate(peer_ids, results):
+        """
+        peer_ids: list of peer_ids
+        results: list of dicts peer_id -> value, one per iteration, e.g. from
+                 uploaded_blocks or completion_rounds
+
+        Returns:
+        dict: peer_id -> (mean, stddev, median) across the iterations, or
+        (None, None, None) for peers with a None value in any iteration.
+        Same numbers as util.mean, util.stddev and util.median.
+        """
+        if np is None:
+            ans = dict()
+            for peer_id in peer_ids:
+                vals = [d[peer_id] for d in results]
+                if None in vals:
+                    ans[peer_id] = (None, None, None)
+                else:
+                    ans[peer_id] = (mean(vals), stddev(vals), median(vals))
+            return ans
+
+        # iterations x peers, with nan standing in for None
+        a = np.array([[d[peer_id] for peer_id in peer_ids] for d in results],
+                     dtype=float)
+        n = a.shape[0]
+        means = a.sum(axis=0) / n
+        stddevs = np.sqrt(((a - means) ** 2).sum(axis=0) / n)
+        medians = np.median(a, axis=0)
+        missing = np.isnan(a).any(axis=0)
+
+        ans = dict()
+        for j, peer_id in enumerate(peer_ids):
+            if missing[j]:
+                ans[peer_id] = (None, None, None)
+            else:
+                ans[peer_id] = (float(means[j]), float(stddevs[j]),
+                                _number(medians[j]))
+        return ans
+
+
+class RunningStats:
+    """
+    Per-peer mean and standard deviation of a stat over the iterations,
+    folded in one iteration at a time from running sums of the values and
+    their squares, so run_sim doesn't have to keep every iteration's
+    history around.  The stats are ints (or close), so the sums stay exact.
+    """
+    def __init__(self, peer_ids):
+        self.peer_ids = peer_ids
+        self.n = 0
+        self.total = dict((pid, 0) for pid in peer_ids)
+        self.total_sq = dict((pid, 0) for pid in peer_ids)
+        self.missing = set()   # peers with a None value in some iteration
+
+    def add(self, d):
+        """d: dict peer_id -> value for one iteration, e.g. from
+        Stats.uploaded_blocks or Stats.completion_rounds"""
+        self.n += 1
+        for pid in self.peer_ids:
+            x = d[pid]
+            if x is None:
+                self.missing.add(pid)
+                continue
+            self.total[pid] += x
+            self.total_sq[pid] += x * x
+
+    def result(self):
+        """
+        Returns:
+        dict: peer_id -> (mean, stddev) over the iterations so far, or
+        (None, None) for peers with a None value in any of them.  Same
+        numbers as util.mean and util.stddev.
+        """
+        n = self.n
+        ans = dict()
+        for pid in self.peer_ids:
+            if pid in self.missing:
+                ans[pid] = (None, None)
+                continue
+            total = self.total[pid]
+            # n^2 * variance; exact while the values are ints
+            spread = max(0, n * self.total_sq[pid] - total * total)
+            ans[pid] = (total / float(n), math.sqrt(spread / float(n * n)))
+        return ans
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+"""
+Checks History's running totals against sums over the raw rounds.
+Usage:  python -m pytest test_history.py
+"""
+
+import contextlib
+import io
+import random
+import unittest
+
+from history import History
+from sim import Sim
+from util import Params, load_modules
+
+
+def make_config(names, num_pieces=40, max_round=300):
+    config = Params()
+    config.add("agent_class_names", names)
+    config.add("agent_classes", load_modules(set(names)))
+    config.add("num_pieces", num_pieces)
+    config.add("blocks_per_piece", 4)
+    config.add("max_round", max_round)
+    config.add("min_up_bw", 4)
+    config.add("max_up_bw", 10)
+    config.add("iters", 1)
+    config.add("workers", 1)
+    config.add("seed", None)
+    config.add("topology", "full")
+    config.add("history_window", None)
+    config.add("history_dir", None)
+    config.add("save_history", None)
+    config.add("batch", True)
+    config.add("event_driven", False)
+    config.add("driver", "serial")
+    config.add("driver_workers", 1)
+    config.add("deadline", None)
+    config.add("trusted_classes", [])
+    config.add("validate_every", 1)
+    return config
+
+
+def run(names, seed):
+    random.seed(seed)
+    # The agents print a greeting when they start up
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Sim(make_config(names)).run_sim_once()
+
+
+class ReceivedRecentTest(unittest.TestCase):
+    # MMJWTyrant uploads fractional bandwidths, so blocks aren't all ints
+    names = ["Seed"] * 2 + ["MMJWStd"] * 6 + ["MMJWTyrant"] * 6
+
+    def test_matches_brute_force(self):
+        for seed in range(1, 4):
+            done = run(self.names, seed)
+            ids = done.peer_ids
+            # Replay the run into a fresh History, checking every round
+            h = History(ids, done.upload_rates)
+            for r in range(done.num_rounds):
+                h.update(
+                    dict((pid, done.downloads_for_round(i, r))
+                         for (i, pid) in enumerate(ids)),
+                    dict((pid, done.uploads_for_round(i, r))
+                         for (i, pid) in enumerate(ids)))
+                for (i, pid) in enumerate(ids):
+                    ah = h.peer_history(pid)
+                    for k in (1, 2, 5):
+                        want = dict()
+                        for q in range(max(0, r + 1 - k), r + 1):
+                            per_round = dict()
+                            for dl in done.downloads_for_round(i, q):
+                                per_round[dl.from_id] = (
+                                    per_round.get(dl.from_id, 0) + dl.blocks)
+                            for (from_id, blocks) in per_round.items():
+                                want[from_id] = want.get(from_id, 0) + blocks
+                        want = dict((p, b) for (p, b) in want.items() if b != 0)
+                        self.assertEqual(dict(ah.received_recent(k)), want,
+                                         (seed, r, pid, k))
+
+
+if __name__ == "__main__":
+    unittest.main()
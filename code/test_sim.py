@@ -0,0 +1,46 @@
+#!/usr/bin/python
+
+"""
+Runs sim.py end to end.  Usage:  python -m pytest test_sim.py
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_sim(*args):
+    """Run sim.py with args; returns (exit code, its output)."""
+    env = dict(os.environ, PYTHONHASHSEED="0")
+    p = subprocess.run([sys.executable, "sim.py", "--loglevel", "warning"] +
+                       list(args),
+                       cwd=HERE, env=env, stdout=subprocess.PIPE,
+                       stderr=subprocess.STDOUT, universal_newlines=True,
+                       timeout=120)
+    return (p.returncode, p.stdout)
+
+
+class WorkersTest(unittest.TestCase):
+    args = ("--iters", "2", "--seed", "1", "--num-pieces", "10",
+            "--max-round", "200", "Seed,1", "MMJWStd,3", "MMJWTyrant,2")
+
+    def test_workers(self):
+        # The histories have to make it back from the worker processes
+        (code, out) = run_sim("--workers", "2", *self.args)
+        self.assertEqual(code, 0, out)
+        self.assertIn("SUMMARY STATS", out)
+
+    def test_workers_match_serial(self):
+        # Only the stats: the agents' greetings interleave with workers
+        (_, serial) = run_sim("--workers", "1", *self.args)
+        (_, parallel) = run_sim("--workers", "2", *self.args)
+        self.assertIn("SUMMARY STATS", serial)
+        self.assertEqual(serial.partition("SUMMARY STATS")[2],
+                         parallel.partition("SUMMARY STATS")[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+"""
+Who can see whom.  By default every peer sees every other peer, which makes
+every round O(P^2).  Real swarms have bounded neighborhoods, so a sim can
+instead use one of these topologies, chosen with config.topology:
+
+  full       everyone is everyone's neighbor (the default)
+  kregular   random graph where every peer has exactly config.degree neighbors
+  tracker    like a tracker handing out peer lists: every peer connects to
+             config.degree random others (so ends up with at least that many)
+  file       edges read from config.edge_file, one "peer_id peer_id" pair per
+             line (blank lines and lines starting with # are skipped)
+
+Neighborhoods are always symmetric: if a can see b, b can see a.
+"""
+
+import random
+
+TOPOLOGIES = ("full", "kregular", "tracker", "file")
+
+
+def check_topology(config, num_peers):
+    """
+    Raise ValueError if config's topology can't be built for num_peers
+    peers, before anything gets run.  (An edge file's contents are only
+    checked once make_topology reads it.)
+    """
+    kind = config.topology
+    if kind not in TOPOLOGIES:
+        raise ValueError("Unknown topology: %s (choose from %s)" % (
+            kind, ", ".join(TOPOLOGIES)))
+    if kind in ("kregular", "tracker") and config.degree < 0:
+        raise ValueError("Degree can't be negative: %d" % config.degree)
+    if kind == "kregular":
+        check_kregular(num_peers, config.degree)
+    if kind == "file" and config.edge_file is None:
+        raise ValueError("The file topology needs an edge file (--edges)")
+
+
+def check_kregular(n, k):
+    if k < 0 or k >= n or (n * k) % 2 != 0:
+        raise ValueError("No %d-regular graph on %d peers "
+                         "(need degree < peers and peers * degree even)" % (k, n))
+
+
+def make_topology(config, peer_ids):
+    """
+    Returns dict: peer_id -> list of neighbor peer_ids, in peer_ids order,
+    or None for the full topology.
+    """
+    kind = config.topology
+    n = len(peer_ids)
+    if kind == "full":
+        return None
+    elif kind == "kregular":
+        edges = kregular_edges(n, config.degree)
+    elif kind == "tracker":
+        edges = tracker_edges(n, config.degree)
+    elif kind == "file":
+        edges = file_edges(config.edge_file, peer_ids)
+    else:
+        raise ValueError("Unknown topology: %s (choose from %s)" % (
+            kind, ", ".join(TOPOLOGIES)))
+
+    neighbors = [set() for i in range(n)]
+    for (a, b) in edges:
+        neighbors[a].add(b)
+        neighbors[b].add(a)
+    return dict((peer_ids[i], [peer_ids[j] for j in sorted(neighbors[i])])
+                for i in range(n))
+
+
+def kregular_edges(n, k):
+    """
+    Edges (as pairs of indexes) of a uniformly-ish random k-regular graph on
+    n nodes, using the Steger-Wormald algorithm: pair up random stubs,
+    keeping the pairs that make new edges and retrying with the rest.
+    """
+    check_kregular(n, k)
+    if k == 0:
+        return set()
+
+    def suitable(edges, leftover):
+        """Can the leftover stubs still make at least one new edge?"""
+        if not leftover:
+            return True
+        for a in leftover:
+            for b in leftover:
+                if a == b:
+                    break
+                if (min(a, b), max(a, b)) not in edges:
+                    return True
+        return False
+
+    def attempt():
+        edges = set()
+        stubs = list(range(n)) * k
+        while stubs:
+            leftover = dict()   # node -> stubs that couldn't be paired
+            random.shuffle(stubs)
+            it = iter(stubs)
+            for a, b in zip(it, it):
+                if a > b:
+                    a, b = b, a
+                if a != b and (a, b) not in edges:
+                    edges.add((a, b))
+                else:
+                    leftover[a] = leftover.get(a, 0) + 1
+                    leftover[b] = leftover.get(b, 0) + 1
+            if not suitable(edges, leftover):
+                return None
+            stubs = [node for node, count in leftover.items()
+                     for i in range(count)]
+        return edges
+
+    edges = attempt()
+    while edges is None:
+        edges = attempt()
+    return edges
+
+
+def tracker_edges(n, k):
+    """Every node connects to min(k, n-1) random others."""
+    edges = set()
+    for a in range(n):
+        # Pick from everyone but a: 0..n-2, shifted up past a
+        for b in random.sample(range(n - 1), min(k, n - 1)):
+            if b >= a:
+                b += 1
+            edges.add((min(a, b), max(a, b)))
+    return edges
+
+
+def file_edges(filename, peer_ids):
+    index = dict((pid, i) for i, pid in enumerate(peer_ids))
+    edges = set()
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            ends = line.split()
+            if len(ends) != 2:
+                raise ValueError("Bad edge in %s: %s" % (filename, line))
+            for pid in ends:
+                if pid not in index:
+                    raise ValueError("Unknown peer in %s: %s" % (filename, pid))
+            (a, b) = (index[ends[0]], index[ends[1]])
+            if a != b:
+                edges.add((min(a, b), max(a, b)))
+    return edges
@@ -6,6 +6,7 @@
 
 from itertools import count
 import math
+import random
 
 
 def argmax(pairs):
@@ -41,7 +42,7 @@ def stddev(lst):
     if len(lst) == 0:
         return 0
     m = mean(lst)
-    return math.sqrt(sum((x-m)*(x-m) for x in lst) // len(lst))
+    return math.sqrt(sum((x-m)*(x-m) for x in lst) / len(lst))
 
 
 def median(numeric):
@@ -56,6 +57,18 @@ def median(numeric):
 
 
 
+def rarest_first(pieces, piece_counts):
+    """
+    Return the pieces as a list ordered from rarest to most common, where
+    piece_counts[i] is how many peers have piece i (e.g. history.piece_counts).
+    Ties are broken randomly.
+    """
+    ans = list(pieces)
+    random.shuffle(ans)
+    ans.sort(key=piece_counts.__getitem__)
+    return ans
+
+
 def even_split(n, k):
     """
     n and k must be ints.